@@ -13,7 +13,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from sqlalchemy import func
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, contains_eager, selectinload
 
 from scripts.db import Company, Delivery, Event, Process, SyncState, get_session
 from scripts.pipeline import (
@@ -103,16 +103,9 @@ def serialize_delivery(delivery: Delivery) -> Dict[str, Any]:
 def serialize_company(company: Company) -> Dict[str, Any]:
     return {
         "id": company.id,
-        "id_acessorias": company.id_acessorias,
         "cnpj": company.cnpj,
         "nome": company.nome,
-        "nome_fantasia": company.nome_fantasia,
-        "email": company.email,
-        "telefone": company.telefone,
-        "cidade": company.cidade,
-        "uf": company.uf,
         "counters": company_counters(company),
-        "raw": company.dados,
     }
 
 
@@ -157,7 +150,11 @@ def processes_endpoint(
     date_to: Optional[str] = Query(None, alias="to"),
     session: Session = Depends(get_db),
 ) -> Dict[str, Any]:
-    query = session.query(Process).join(Company, isouter=True)
+    query = (
+        session.query(Process)
+        .join(Company, isouter=True)
+        .options(contains_eager(Process.company))
+    )
 
     if status:
         query = query.filter(Process.status.ilike(f"%{status}%"))
@@ -197,7 +194,7 @@ def processes_concluidos(
     competencia: Optional[str] = Query(None, description="Competência YYYY-MM"),
     session: Session = Depends(get_db),
 ) -> Dict[str, Any]:
-    query = session.query(Process)
+    query = session.query(Process).options(selectinload(Process.company))
     query = query.filter(Process.status.in_(["C", "CONCLUIDO", "CONCLUÍDO", "CONCLUIDO"]))
     if competencia:
         query = query.filter(func.strftime("%Y-%m", Process.dt_conclusao) == competencia)
@@ -218,7 +215,11 @@ def deliveries_endpoint(
     offset: int = Query(0, ge=0),
     session: Session = Depends(get_db),
 ) -> Dict[str, Any]:
-    query = session.query(Delivery).join(Company, isouter=True)
+    query = (
+        session.query(Delivery)
+        .join(Company, isouter=True)
+        .options(contains_eager(Delivery.company))
+    )
     if empresa:
         pattern = f"%{empresa.replace('%', '')}%"
         digits = re.sub(r"\D", "", empresa)
@@ -252,7 +253,12 @@ def deliveries_endpoint(
 
 @app.get("/api/companies")
 def companies_endpoint(session: Session = Depends(get_db)) -> Dict[str, Any]:
-    companies = session.query(Company).order_by(Company.nome.asc()).all()
+    companies = (
+        session.query(Company)
+        .options(selectinload(Company.deliveries))
+        .order_by(Company.nome.asc())
+        .all()
+    )
     if not companies:
         fallback = load_fallback("companies.json")
         return {"items": fallback, "total": len(fallback), "source": "json"}
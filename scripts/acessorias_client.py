@@ -11,6 +11,7 @@ import logging
 from datetime import datetime, timedelta
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from scripts.utils.logger import log
 from scripts.utils import normalization
@@ -19,6 +20,15 @@ LOG = logging.getLogger("acessorias_client")
 
 _MAX_RETRIES = 7
 
+# Pool de conexões compartilhado pelos clientes do processo. Quem aproveita é o
+# pipeline.py: o fan-out por CNPJ do sync full faz FULL_SYNC_WORKERS buscas
+# simultâneas (daí o pool_maxsize), e os clientes de collect_processes,
+# collect_deliveries e collect_companies reaproveitam as conexões TLS já
+# abertas. Os coletores do scheduler rodam cada um no seu subprocesso, então lá
+# o pool vale só dentro de cada coletor. Sem Retry do urllib3: _request já tem
+# a própria política
+_HTTP_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+
 
 def _clean_cnpj(value: Optional[str]) -> Optional[str]:
     if not value:
@@ -43,6 +53,8 @@ class AcessoriasClient:
             + "/"
         )
         self.session = requests.Session()
+        self.session.mount("https://", _HTTP_ADAPTER)
+        self.session.mount("http://", _HTTP_ADAPTER)
         # HEADERS CANÔNICOS
         self.session.headers.update({
             "Authorization": f"Bearer {token.strip()}",
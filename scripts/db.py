@@ -1,22 +1,25 @@
 # scripts/db.py
 """
 Camada de banco de dados com SQLAlchemy.
-Define modelos (Company, Process, Delivery) e helpers de upsert.
+Define modelos (Company, Process, Delivery, Event, SyncState) e helpers de upsert.
 """
 from __future__ import annotations
 
 import os
+import json
 import hashlib
-from datetime import datetime
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 from sqlalchemy import (
-    Column, String, Integer, DateTime, Boolean, Text, ForeignKey,
-    UniqueConstraint, Index, create_engine, event
+    Column, String, Integer, DateTime, Boolean, Text, ForeignKey, JSON,
+    UniqueConstraint, Index, create_engine, event, func
 )
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, synonym, Session
 from sqlalchemy.engine import Engine
+from sqlalchemy.types import TypeDecorator
 from dotenv import load_dotenv
 
 # Carrega .env
@@ -25,6 +28,50 @@ load_dotenv(dotenv_path=Path(__file__).resolve().parents[1] / ".env", override=T
 # Base declarativa
 Base = declarative_base()
 
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """As colunas guardam datetime ingênuo em UTC; devolve com fuso."""
+    if value is None or value.tzinfo is not None:
+        return value
+    return value.replace(tzinfo=timezone.utc)
+
+
+def _utc_alias(column: str) -> hybrid_property:
+    """
+    Nome usado pelo pipeline/API para uma coluna existente: no SQL é a própria
+    coluna; na instância devolve o valor com fuso UTC (comparável a ``now``).
+    """
+    return hybrid_property(
+        lambda self: _as_utc(getattr(self, column)),
+        expr=lambda cls: getattr(cls, column),
+    )
+
+
+def _raw_json(value: Optional[str]) -> Dict[str, Any]:
+    if not value:
+        return {}
+    try:
+        data = json.loads(value)
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+class UTCDateTime(TypeDecorator):
+    """DateTime gravado ingênuo em UTC e lido de volta com fuso UTC."""
+
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        return _as_utc(value)
+
+
 # ============================================================================
 # MODELOS
 # ============================================================================
@@ -74,6 +121,35 @@ class Process(Base):
         Index("ix_processes_company", "company_id"),
     )
 
+    # Nomes usados pelo pipeline/API sobre as mesmas colunas
+    id = synonym("proc_id")
+    id_acessorias = synonym("proc_id")
+    empresa_id = synonym("company_id")
+    dt_inicio = _utc_alias("inicio")
+    dt_conclusao = _utc_alias("conclusao")
+    ultimo_evento = _utc_alias("last_dh")
+
+    @property
+    def raw(self) -> Dict[str, Any]:
+        return _raw_json(self.raw_data)
+
+    @property
+    def dt_prev_conclusao(self) -> Optional[datetime]:
+        return parse_datetime(self.raw.get("ProcPrevConclusao"))
+
+    @property
+    def departamento(self) -> Optional[str]:
+        raw = self.raw
+        return raw.get("ProcDepartamento") or raw.get("Departamento")
+
+    @property
+    def prioridade(self) -> Optional[str]:
+        return self.raw.get("ProcPrioridade")
+
+    @property
+    def progresso(self) -> Any:
+        return self.raw.get("ProcPorcentagem")
+
 
 class Delivery(Base):
     """Representa uma obrigação/entrega fiscal."""
@@ -103,6 +179,65 @@ class Delivery(Base):
         Index("ix_deliveries_company", "company_id"),
     )
 
+    # Nomes usados pelo pipeline/API sobre as mesmas colunas
+    empresa_id = synonym("company_id")
+    tipo = synonym("nome")
+    situacao = synonym("status")
+    dt_prazo = _utc_alias("prazo")
+    dt_entrega = _utc_alias("entregue_em")
+
+    @property
+    def payload(self) -> Dict[str, Any]:
+        return _raw_json(self.raw_data)
+
+    @property
+    def id_acessorias(self) -> Optional[str]:
+        return self.payload.get("EntID")
+
+    @property
+    def dt_evento(self) -> Optional[datetime]:
+        payload = self.payload
+        return parse_datetime(payload.get("EntDtEvento") or payload.get("EntLastDH"))
+
+    @property
+    def responsavel(self) -> Optional[str]:
+        return self.payload.get("Responsavel")
+
+
+class Event(Base):
+    """Evento derivado de processos/deliveries (reconstruído a cada build_events)."""
+    __tablename__ = "events"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    process_id = Column(String, ForeignKey("processes.proc_id"))
+    company_id = Column(String, ForeignKey("companies.id"))
+    delivery_id = Column(String, ForeignKey("deliveries.id"))
+    tipo = Column(String)
+    dt = Column(UTCDateTime)
+    referencia = Column(String)
+    processo_status = Column(String)
+    payload = Column(JSON)
+
+    process = relationship("Process")
+    company = relationship("Company")
+    delivery = relationship("Delivery")
+
+    __table_args__ = (
+        Index("ix_events_dt", "dt"),
+        Index("ix_events_tipo", "tipo"),
+    )
+
+
+class SyncState(Base):
+    """Controle incremental do pipeline por endpoint (processes, deliveries)."""
+    __tablename__ = "sync_state"
+
+    endpoint = Column(String, primary_key=True)
+    last_sync_dh = Column(UTCDateTime)
+    last_page = Column(Integer)
+    updated_at = Column(UTCDateTime, default=lambda: datetime.now(timezone.utc),
+                        onupdate=lambda: datetime.now(timezone.utc))
+
 
 # ============================================================================
 # ENGINE E SESSION
@@ -132,6 +267,8 @@ def set_sqlite_pragma(dbapi_conn, connection_record):
         cursor = dbapi_conn.cursor()
         cursor.execute("PRAGMA journal_mode=WAL")
         cursor.execute("PRAGMA synchronous=NORMAL")
+        # Etapas do pipeline gravam em paralelo: espera o lock em vez de falhar
+        cursor.execute("PRAGMA busy_timeout=30000")
         cursor.close()
 
 
@@ -173,6 +310,17 @@ def init_db():
     Base.metadata.create_all(bind=engine)
 
 
+_DB_READY = False
+
+
+def ensure_database() -> None:
+    """``init_db`` uma vez por processo (o pipeline chama a cada etapa)."""
+    global _DB_READY
+    if not _DB_READY:
+        init_db()
+        _DB_READY = True
+
+
 def get_session() -> Session:
     """Retorna uma nova sessão do banco de dados."""
     SessionLocal = get_session_local()
@@ -196,130 +344,73 @@ def generate_delivery_id(company_id: str, nome: str, competencia: str) -> str:
     return hashlib.sha1(key.encode("utf-8")).hexdigest()
 
 
-def upsert_company(session: Session, data: Dict[str, Any]) -> Company:
-    """
-    Insere ou atualiza uma empresa.
-    
-    Args:
-        session: Sessão do SQLAlchemy
-        data: Dicionário com dados da empresa (deve conter 'cnpj' ou 'id')
-    
-    Returns:
-        Instância de Company
-    """
-    cnpj = normalize_cnpj(data.get("cnpj") or data.get("CNPJ") or data.get("id"))
+def _parse_date(value: Any) -> Optional[datetime]:
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    from dateutil import parser as date_parser
+    try:
+        return date_parser.parse(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def parse_datetime(value: Any) -> Optional[datetime]:
+    """Como ``_parse_date``, mas sempre com fuso (UTC quando o valor não traz)."""
+    parsed = _parse_date(value)
+    if parsed is None:
+        return None
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def company_row(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Projeta o payload de uma empresa nas colunas de ``companies``."""
+    cnpj = normalize_cnpj(
+        data.get("cnpj") or data.get("CNPJ") or data.get("id") or data.get("Identificador")
+    )
     if not cnpj:
         raise ValueError("CNPJ não fornecido para upsert_company")
-    
-    company = session.query(Company).filter_by(id=cnpj).first()
-    
-    if company:
-        # Atualizar
-        company.nome = data.get("nome") or data.get("Nome") or company.nome
-        company.cnpj = cnpj
-        company.updated_at = datetime.utcnow()
-    else:
-        # Inserir
-        company = Company(
-            id=cnpj,
-            nome=data.get("nome") or data.get("Nome") or "",
-            cnpj=cnpj,
-            updated_at=datetime.utcnow()
-        )
-        session.add(company)
-    
-    return company
+    return {
+        "id": cnpj,
+        "nome": data.get("nome") or data.get("Nome") or data.get("Razao") or data.get("EmpNome") or "",
+        "cnpj": cnpj,
+        "updated_at": datetime.utcnow(),
+    }
 
 
-def upsert_process(session: Session, data: Dict[str, Any]) -> Process:
-    """
-    Insere ou atualiza um processo.
-    
-    Args:
-        session: Sessão do SQLAlchemy
-        data: Dicionário com dados do processo (deve conter 'proc_id' ou 'ProcID')
-    
-    Returns:
-        Instância de Process
-    """
-    import json
-    from dateutil import parser as date_parser
-    
+def process_row(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Projeta o payload de um processo nas colunas de ``processes``."""
     proc_id = data.get("proc_id") or data.get("ProcID")
     if not proc_id:
         raise ValueError("proc_id não fornecido para upsert_process")
-    
-    process = session.query(Process).filter_by(proc_id=proc_id).first()
-    
-    # Parsear datas
-    def parse_date(value):
-        if not value:
-            return None
-        if isinstance(value, datetime):
-            return value
-        try:
-            return date_parser.parse(value)
-        except:
-            return None
-    
-    inicio = parse_date(data.get("inicio") or data.get("ProcInicio"))
-    conclusao = parse_date(data.get("conclusao") or data.get("ProcConclusao"))
-    last_dh = parse_date(data.get("last_dh") or data.get("DtLastDH"))
-    
-    # Company ID
-    company_cnpj = normalize_cnpj(
-        data.get("company_id") or 
-        data.get("cnpj") or 
-        data.get("CNPJ") or 
-        data.get("EmpCNPJ")
-    )
-    
-    if process:
-        # Atualizar
-        process.titulo = data.get("titulo") or data.get("ProcNome") or process.titulo
-        process.status = data.get("status") or data.get("ProcStatus") or process.status
-        process.inicio = inicio or process.inicio
-        process.conclusao = conclusao or process.conclusao
-        process.gestor = data.get("gestor") or data.get("GestorNome") or process.gestor
-        process.dias_corridos = data.get("dias_corridos") or data.get("ProcDiasCorridos") or process.dias_corridos
-        process.company_id = company_cnpj or process.company_id
-        process.last_dh = last_dh or process.last_dh
-        process.raw_data = json.dumps(data, ensure_ascii=False)
-        process.updated_at = datetime.utcnow()
-    else:
-        # Inserir
-        process = Process(
-            proc_id=proc_id,
-            titulo=data.get("titulo") or data.get("ProcNome") or "",
-            status=data.get("status") or data.get("ProcStatus") or "",
-            inicio=inicio,
-            conclusao=conclusao,
-            gestor=data.get("gestor") or data.get("GestorNome") or "",
-            dias_corridos=data.get("dias_corridos") or data.get("ProcDiasCorridos"),
-            company_id=company_cnpj,
-            last_dh=last_dh,
-            raw_data=json.dumps(data, ensure_ascii=False),
-            updated_at=datetime.utcnow()
-        )
-        session.add(process)
-    
-    return process
-
-
-def upsert_delivery(session: Session, data: Dict[str, Any]) -> Delivery:
+    return {
+        "proc_id": proc_id,
+        "titulo": data.get("titulo") or data.get("ProcNome") or "",
+        "status": data.get("status") or data.get("ProcStatus") or "",
+        "inicio": _parse_date(data.get("inicio") or data.get("ProcInicio")),
+        "conclusao": _parse_date(data.get("conclusao") or data.get("ProcConclusao")),
+        "gestor": data.get("gestor") or data.get("GestorNome") or data.get("ProcGestor") or "",
+        "dias_corridos": data.get("dias_corridos") or data.get("ProcDiasCorridos"),
+        "company_id": normalize_cnpj(
+            data.get("company_id") or
+            data.get("cnpj") or
+            data.get("CNPJ") or
+            data.get("EmpCNPJ")
+        ),
+        "last_dh": _parse_date(data.get("last_dh") or data.get("DtLastDH")),
+        "raw_data": json.dumps(data, ensure_ascii=False),
+        "updated_at": datetime.utcnow(),
+    }
+
+
+def delivery_row(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     """
-    Insere ou atualiza uma delivery (obrigação fiscal).
-    
-    Args:
-        session: Sessão do SQLAlchemy
-        data: Dicionário com dados da delivery
-    
-    Returns:
-        Instância de Delivery ou None se dados inválidos
+    Projeta o payload de uma delivery nas colunas de ``deliveries``.
+    Retorna None quando não há dados mínimos para persistir.
     """
-    import json
-    from dateutil import parser as date_parser
-    
     # Extrair campos chave
     company_cnpj = normalize_cnpj(
         data.get("company_id") or 
@@ -341,7 +432,6 @@ def upsert_delivery(session: Session, data: Dict[str, Any]) -> Delivery:
     
     # Se ainda não tem competencia, usar mês atual
     if not competencia:
-        from datetime import datetime
         competencia = datetime.utcnow().strftime("%Y-%m")
     
     # Validar campos mínimos
@@ -357,25 +447,6 @@ def upsert_delivery(session: Session, data: Dict[str, Any]) -> Delivery:
     except:
         return None  # Se falhar ao gerar ID, descartar
     
-    try:
-        delivery = session.query(Delivery).filter_by(id=delivery_id).first()
-    except:
-        delivery = None
-    
-    # Parsear datas
-    def parse_date(value):
-        if not value:
-            return None
-        if isinstance(value, datetime):
-            return value
-        try:
-            return date_parser.parse(value)
-        except:
-            return None
-    
-    prazo = parse_date(data.get("prazo") or data.get("Prazo"))
-    entregue_em = parse_date(data.get("entregue_em") or data.get("EntregueEm"))
-    
     # Determinar categoria
     categoria = data.get("categoria", "")
     if not categoria:
@@ -400,74 +471,312 @@ def upsert_delivery(session: Session, data: Dict[str, Any]) -> Delivery:
         elif "COMERCIALIZAÇÃO" in nome_upper or "COMERCIALIZACAO" in nome_upper:
             subtipo = "comercializacao"
     
+    return {
+        "id": delivery_id,
+        "company_id": company_cnpj,
+        "nome": nome,
+        "categoria": categoria,
+        "subtipo": subtipo,
+        "status": data.get("status") or data.get("Status") or "",
+        "competencia": competencia,
+        "prazo": _parse_date(data.get("prazo") or data.get("Prazo") or data.get("EntDtPrazo")),
+        "entregue_em": _parse_date(
+            data.get("entregue_em") or data.get("EntregueEm") or data.get("EntDtEntrega")
+        ),
+        "raw_data": json.dumps(data, ensure_ascii=False),
+        "updated_at": datetime.utcnow(),
+    }
+
+
+def upsert_company(session: Session, data: Dict[str, Any]) -> Company:
+    """
+    Insere ou atualiza uma empresa.
+    
+    Args:
+        session: Sessão do SQLAlchemy
+        data: Dicionário com dados da empresa (deve conter 'cnpj' ou 'id')
+    
+    Returns:
+        Instância de Company
+    """
+    row = company_row(data)
+    company = session.query(Company).filter_by(id=row["id"]).first()
+    
+    if company:
+        # Atualizar
+        company.nome = row["nome"] or company.nome
+        company.cnpj = row["cnpj"]
+        company.updated_at = row["updated_at"]
+    else:
+        # Inserir
+        company = Company(**row)
+        session.add(company)
+    
+    return company
+
+
+def upsert_process(session: Session, data: Dict[str, Any]) -> Process:
+    """
+    Insere ou atualiza um processo.
+    
+    Args:
+        session: Sessão do SQLAlchemy
+        data: Dicionário com dados do processo (deve conter 'proc_id' ou 'ProcID')
+    
+    Returns:
+        Instância de Process
+    """
+    row = process_row(data)
+    process = session.query(Process).filter_by(proc_id=row["proc_id"]).first()
+    
+    if process:
+        # Atualizar
+        process.titulo = row["titulo"] or process.titulo
+        process.status = row["status"] or process.status
+        process.inicio = row["inicio"] or process.inicio
+        process.conclusao = row["conclusao"] or process.conclusao
+        process.gestor = row["gestor"] or process.gestor
+        process.dias_corridos = row["dias_corridos"] or process.dias_corridos
+        process.company_id = row["company_id"] or process.company_id
+        process.last_dh = row["last_dh"] or process.last_dh
+        process.raw_data = row["raw_data"]
+        process.updated_at = row["updated_at"]
+    else:
+        # Inserir
+        process = Process(**row)
+        session.add(process)
+    
+    return process
+
+
+def upsert_delivery(session: Session, data: Dict[str, Any]) -> Delivery:
+    """
+    Insere ou atualiza uma delivery (obrigação fiscal).
+    
+    Args:
+        session: Sessão do SQLAlchemy
+        data: Dicionário com dados da delivery
+    
+    Returns:
+        Instância de Delivery ou None se dados inválidos
+    """
+    row = delivery_row(data)
+    if row is None:
+        return None
+    
+    try:
+        delivery = session.query(Delivery).filter_by(id=row["id"]).first()
+    except:
+        delivery = None
+    
     if delivery:
         # Atualizar
-        delivery.company_id = company_cnpj
-        delivery.nome = nome
-        delivery.categoria = categoria
-        delivery.subtipo = subtipo
-        delivery.status = data.get("status") or data.get("Status") or delivery.status
-        delivery.competencia = competencia
-        delivery.prazo = prazo or delivery.prazo
-        delivery.entregue_em = entregue_em or delivery.entregue_em
-        delivery.raw_data = json.dumps(data, ensure_ascii=False)
-        delivery.updated_at = datetime.utcnow()
+        delivery.company_id = row["company_id"]
+        delivery.nome = row["nome"]
+        delivery.categoria = row["categoria"]
+        delivery.subtipo = row["subtipo"]
+        delivery.status = row["status"] or delivery.status
+        delivery.competencia = row["competencia"]
+        delivery.prazo = row["prazo"] or delivery.prazo
+        delivery.entregue_em = row["entregue_em"] or delivery.entregue_em
+        delivery.raw_data = row["raw_data"]
+        delivery.updated_at = row["updated_at"]
     else:
         # Inserir
-        delivery = Delivery(
-            id=delivery_id,
-            company_id=company_cnpj,
-            nome=nome,
-            categoria=categoria,
-            subtipo=subtipo,
-            status=data.get("status") or data.get("Status") or "",
-            competencia=competencia,
-            prazo=prazo,
-            entregue_em=entregue_em,
-            raw_data=json.dumps(data, ensure_ascii=False),
-            updated_at=datetime.utcnow()
-        )
+        delivery = Delivery(**row)
         session.add(delivery)
     
     return delivery
 
 
+# ============================================================================
+# UPSERT EM LOTE (SQLAlchemy Core)
+# ============================================================================
+
+# Colunas em que um valor vazio no payload preserva o que já está no banco
+# (mesma regra do "novo or antigo" dos upserts via ORM)
+_KEEP_IF_EMPTY = {
+    "companies": ("nome",),
+    "processes": ("titulo", "status", "inicio", "conclusao", "gestor",
+                  "dias_corridos", "company_id", "last_dh"),
+    "deliveries": ("status", "prazo", "entregue_em"),
+}
+
+
+def _dialect_insert(session: Session):
+    """``insert`` com suporte a ON CONFLICT para o dialeto da sessão (ou None)."""
+    name = session.get_bind().dialect.name
+    if name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    if name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    return None
+
+
+def _bulk_upsert_rows(session: Session, model, rows: List[Dict[str, Any]]) -> None:
+    """Um único INSERT ... ON CONFLICT DO UPDATE para todas as linhas do lote."""
+    table = model.__table__
+    pk = [col.name for col in table.primary_key.columns]
+    # Sem chaves repetidas no mesmo comando (o PostgreSQL rejeita); vale a última
+    rows = list({tuple(row[k] for k in pk): row for row in rows}.values())
+    stmt = _dialect_insert(session)(table)
+    keep = _KEEP_IF_EMPTY.get(table.name, ())
+    set_ = {}
+    for name in rows[0]:
+        if name in pk:
+            continue
+        new = stmt.excluded[name]
+        if name in keep:
+            if isinstance(table.c[name].type, String):
+                new = func.nullif(new, "")
+            new = func.coalesce(new, table.c[name])
+        set_[name] = new
+    session.execute(stmt.on_conflict_do_update(index_elements=pk, set_=set_), rows)
+
+
 def bulk_upsert_companies(session: Session, companies: List[Dict[str, Any]]) -> int:
     """Faz upsert em lote de empresas."""
-    count = 0
+    if _dialect_insert(session) is None:
+        count = 0
+        for company_data in companies:
+            try:
+                upsert_company(session, company_data)
+                count += 1
+            except Exception as e:
+                print(f"Erro ao fazer upsert de company: {e}")
+        session.commit()
+        return count
+
+    rows = []
     for company_data in companies:
         try:
-            upsert_company(session, company_data)
-            count += 1
+            rows.append(company_row(company_data))
         except Exception as e:
             print(f"Erro ao fazer upsert de company: {e}")
+    if rows:
+        _bulk_upsert_rows(session, Company, rows)
     session.commit()
-    return count
+    return len(rows)
 
 
 def bulk_upsert_processes(session: Session, processes: List[Dict[str, Any]]) -> int:
     """Faz upsert em lote de processos."""
-    count = 0
+    if _dialect_insert(session) is None:
+        count = 0
+        for process_data in processes:
+            try:
+                upsert_process(session, process_data)
+                count += 1
+            except Exception as e:
+                print(f"Erro ao fazer upsert de process: {e}")
+        session.commit()
+        return count
+
+    rows = []
     for process_data in processes:
         try:
-            upsert_process(session, process_data)
-            count += 1
+            rows.append(process_row(process_data))
         except Exception as e:
             print(f"Erro ao fazer upsert de process: {e}")
+    if rows:
+        _bulk_upsert_rows(session, Process, rows)
     session.commit()
-    return count
+    return len(rows)
 
 
 def bulk_upsert_deliveries(session: Session, deliveries: List[Dict[str, Any]]) -> int:
     """Faz upsert em lote de deliveries."""
-    count = 0
+    if _dialect_insert(session) is None:
+        count = 0
+        for delivery_data in deliveries:
+            try:
+                result = upsert_delivery(session, delivery_data)
+                if result:  # Só conta se foi bem-sucedido
+                    count += 1
+            except Exception as e:
+                # Log silencioso para não poluir output com erros de validação
+                pass
+        session.commit()
+        return count
+
+    rows = []
     for delivery_data in deliveries:
         try:
-            result = upsert_delivery(session, delivery_data)
-            if result:  # Só conta se foi bem-sucedido
-                count += 1
-        except Exception as e:
+            row = delivery_row(delivery_data)
+        except Exception:
             # Log silencioso para não poluir output com erros de validação
-            pass
+            continue
+        if row:  # Só conta se foi bem-sucedido
+            rows.append(row)
+    if rows:
+        _bulk_upsert_rows(session, Delivery, rows)
     session.commit()
-    return count
+    return len(rows)
+
+
+# ============================================================================
+# SYNC STATE E EVENTOS (pipeline)
+# ============================================================================
+
+def get_sync_state(session: Session, endpoint: str) -> Optional[SyncState]:
+    """Estado incremental do endpoint (None se nunca sincronizou)."""
+    return session.get(SyncState, endpoint)
+
+
+def save_sync_state(
+    session: Session,
+    *,
+    endpoint: str,
+    last_sync_dh: Optional[datetime],
+    last_page: Optional[int] = None,
+) -> SyncState:
+    """Grava o estado do endpoint; o commit fica com o chamador."""
+    state = session.get(SyncState, endpoint)
+    if state is None:
+        state = SyncState(endpoint=endpoint)
+        session.add(state)
+    state.last_sync_dh = last_sync_dh
+    state.last_page = last_page
+    return state
+
+
+def reset_sync_state(session: Session, endpoint: str) -> None:
+    """Esquece o estado do endpoint: a próxima coleta é completa."""
+    session.query(SyncState).filter_by(endpoint=endpoint).delete()
+
+
+def clear_events(session: Session) -> None:
+    """Apaga todos os eventos (build_events reconstrói a tabela inteira)."""
+    session.query(Event).delete()
+
+
+def upsert_event(
+    session: Session,
+    *,
+    process: Optional[Process],
+    company: Optional[Company],
+    delivery: Optional[Delivery],
+    tipo: str,
+    dt: Optional[datetime],
+    payload: Dict[str, Any],
+    referencia: Optional[str] = None,
+    processo_status: Optional[str] = None,
+) -> Event:
+    """
+    Registra um evento. Como a tabela é limpa por ``clear_events`` antes de cada
+    reconstrução, não há linha anterior a atualizar: basta inserir.
+    """
+    evt = Event(
+        process_id=process.proc_id if process else None,
+        company_id=company.id if company else None,
+        delivery_id=delivery.id if delivery else None,
+        tipo=tipo,
+        dt=dt,
+        referencia=referencia,
+        processo_status=processo_status,
+        payload=payload,
+    )
+    session.add(evt)
+    return evt
@@ -47,6 +47,7 @@ from dotenv import load_dotenv
 load_dotenv(dotenv_path=Path(__file__).resolve().parents[1] / ".env", override=True)
 
 from scripts.acessorias_client import AcessoriasClient
+from scripts.utils.date_helpers import parse_iso
 
 # normalize_structure com fallback (identidade) se util não existir
 try:
@@ -57,7 +58,7 @@ except Exception:
 
 # Importar módulos do banco de dados
 try:
-    from scripts.db import get_session, init_db, bulk_upsert_processes, upsert_company
+    from scripts.db import get_session, init_db, bulk_upsert_companies, bulk_upsert_processes
     DB_AVAILABLE = True
 except Exception as e:
     logger.warning(f"Banco de dados não disponível: {e}")
@@ -99,7 +100,10 @@ def load_sync_state() -> Dict[str, Any]:
 
 
 def save_sync_state(state: Dict[str, Any]) -> None:
-    SYNC_STATE.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+    # tmp + os.replace: quem lê ao mesmo tempo vê o arquivo antigo ou o novo, nunca pela metade
+    tmp = SYNC_STATE.with_name(SYNC_STATE.name + ".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, SYNC_STATE)
 
 
 def compute_dt_last_dh(last_value: Optional[str]) -> Optional[str]:
@@ -110,8 +114,8 @@ def compute_dt_last_dh(last_value: Optional[str]) -> Optional[str]:
     if not last_value:
         return None
     try:
-        dt_last = parser.isoparse(last_value)
-    except (ValueError, TypeError, parser.ParserError):
+        dt_last = parse_iso(last_value)
+    except (ValueError, TypeError, AttributeError):
         return None
     dt_last = dt_last - timedelta(minutes=5)
     dt_last = dt_last.astimezone(timezone.utc).replace(microsecond=0)
@@ -163,7 +167,7 @@ def normalize_rows(rows: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
     return normalized
 
 
-def parse_args() -> argparse.Namespace:
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     p = argparse.ArgumentParser(description="Fetch Acessórias processes")
     p.add_argument(
         "--full",
@@ -182,12 +186,13 @@ def parse_args() -> argparse.Namespace:
         default=None,
         help="Adicionar filtro ProcStatus (pode repetir). Ex: --status C --status A",
     )
-    return p.parse_args()
+    return p.parse_args(argv)
 
 
 # ------------------------ Main ------------------------ #
-def main() -> None:
-    args = parse_args()
+def main(argv: Optional[List[str]] = None) -> None:
+    """``argv`` permite chamar em processo (ex.: scheduler) sem depender de sys.argv."""
+    args = parse_args(argv)
 
     # Valida token cedo para mensagens mais claras
     token = (os.getenv("ACESSORIAS_TOKEN") or "").strip()
@@ -275,23 +280,18 @@ def main() -> None:
             init_db()
             session = get_session()
             
-            # Extrair empresas únicas e fazer upsert
-            companies_seen = set()
+            # Extrair empresas únicas e fazer upsert em lote
+            companies: Dict[str, Dict[str, Any]] = {}
             for item in normalized:
                 cnpj = item.get("CNPJ") or item.get("cnpj") or item.get("EmpCNPJ")
                 if cnpj:
                     cnpj_clean = "".join(c for c in str(cnpj) if c.isdigit())
-                    if cnpj_clean and cnpj_clean not in companies_seen:
-                        companies_seen.add(cnpj_clean)
-                        try:
-                            upsert_company(session, {
-                                "cnpj": cnpj_clean,
-                                "nome": item.get("EmpNome") or item.get("empresa_nome") or ""
-                            })
-                        except Exception as e:
-                            logger.warning(f"Erro ao fazer upsert de company {cnpj_clean}: {e}")
-            
-            session.commit()
+                    if cnpj_clean and cnpj_clean not in companies:
+                        companies[cnpj_clean] = {
+                            "cnpj": cnpj_clean,
+                            "nome": item.get("EmpNome") or item.get("empresa_nome") or ""
+                        }
+            bulk_upsert_companies(session, list(companies.values()))
             
             # Fazer upsert dos processos
             count = bulk_upsert_processes(session, normalized)
@@ -308,6 +308,9 @@ def main() -> None:
 
     # atualiza controle incremental (sempre salva o “agora”)
     now_utc = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+    # Relê antes de gravar: outros coletores (deliveries) podem ter atualizado
+    # as próprias chaves enquanto este rodava
+    sync_state = load_sync_state()
     sync_state.setdefault("api", {})["last_sync"] = now_utc
     save_sync_state(sync_state)
     log("fetch_api", "INFO", "Atualizado sync", last_sync=now_utc)
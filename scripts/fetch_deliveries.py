@@ -8,11 +8,12 @@ from __future__ import annotations
 
 import os
 import json
+from functools import lru_cache
+from hashlib import blake2b
 from datetime import date, datetime, timedelta, time, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
-from dateutil import parser
 from dotenv import load_dotenv
 
 # ---- logger com fallback -----------------------------------
@@ -40,12 +41,13 @@ except Exception:
 
 # ---- normalization com fallback -----------------------------
 try:
-    from scripts.utils.normalization import normalize_structure
+    from scripts.utils.normalization import normalize_structures
 except Exception:
-    def normalize_structure(x):  # type: ignore
-        return x
+    def normalize_structures(items):  # type: ignore
+        return list(items)
 
 from scripts.acessorias_client import AcessoriasClient
+from scripts.utils.date_helpers import parse_iso
 
 # Importar módulos do banco de dados
 try:
@@ -60,6 +62,7 @@ DATA = ROOT / "data"
 CONFIG_PATH = ROOT / "scripts" / "config.json"
 SYNC_STATE = DATA / ".sync_state.json"
 OUTPUT = DATA / "deliveries_raw.json"
+UPSERT_CHUNK_SIZE = 1000
 
 # Carrega .env da raiz do projeto
 load_dotenv(dotenv_path=ROOT / ".env", override=True)
@@ -69,8 +72,16 @@ def ensure_dirs() -> None:
     DATA.mkdir(exist_ok=True)
 
 
+@lru_cache(maxsize=None)
+def _load_json_cached(path_str: str, mtime: float, size: int) -> Dict[str, Any]:
+    # mtime/size entram só na chave do cache: mudou o arquivo, relê
+    return json.loads(Path(path_str).read_text(encoding="utf-8"))
+
+
 def load_config() -> Dict[str, Any]:
-    return json.loads(CONFIG_PATH.read_text(encoding="utf-8"))
+    """Lê config.json, reaproveitando o parse enquanto o arquivo não mudar (não mutar o retorno)."""
+    st = CONFIG_PATH.stat()
+    return _load_json_cached(str(CONFIG_PATH), st.st_mtime, st.st_size)
 
 
 def load_sync_state() -> Dict[str, Any]:
@@ -83,33 +94,56 @@ def load_sync_state() -> Dict[str, Any]:
 
 
 def save_sync_state(state: Dict[str, Any]) -> None:
-    SYNC_STATE.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+    # tmp + os.replace: quem lê ao mesmo tempo vê o arquivo antigo ou o novo, nunca pela metade
+    tmp = SYNC_STATE.with_name(SYNC_STATE.name + ".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, SYNC_STATE)
 
 
-def compute_dt_last_dh(last_value: Optional[str]) -> str:
+def write_snapshots(serialized: bytes, primary: Path, mirror: Path) -> None:
+    """
+    Grava ``serialized`` de forma atômica em ``primary`` e em ``mirror``, cada um
+    com seu próprio tmp + os.replace, sem serializar duas vezes. Os arquivos
+    ficam independentes: o pipeline regrava cada um por conta própria.
+    """
+    for path in (primary, mirror):
+        tmp = path.with_suffix(".json.tmp")
+        tmp.write_bytes(serialized)
+        os.replace(tmp, path)
+
+
+@lru_cache(maxsize=128)
+def _parse_last(last_value: str) -> Optional[datetime]:
+    """Converte o último sync (ISO) para datetime local ingênuo, já com a margem de 5 min."""
+    try:
+        parsed = parse_iso(last_value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    if parsed.tzinfo:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed - timedelta(minutes=5)
+
+
+def compute_dt_last_dh(last_value: Optional[str], today: Optional[date] = None) -> str:
     """
     Calcula DtLastDH para delta diário.
     Se não houver último valor, usa ontem.
     """
-    floor = datetime.combine(date.today() - timedelta(days=1), time.min)
+    today = today or date.today()
+    floor = datetime.combine(today - timedelta(days=1), time.min)
     
-    if last_value:
-        try:
-            parsed = parser.isoparse(last_value)
-            if parsed.tzinfo:
-                parsed = parsed.astimezone().replace(tzinfo=None)
-            parsed = parsed - timedelta(minutes=5)
-            if parsed < floor:
-                parsed = floor
-        except:
-            parsed = floor
-    else:
+    parsed = _parse_last(last_value) if last_value else None
+    if parsed is None or parsed < floor:
         parsed = floor
     
     return parsed.strftime("%Y-%m-%d %H:%M:%S")
 
 
-def fetch_historical_by_cnpj(client: AcessoriasClient, months_back: int = 6) -> List[Dict[str, Any]]:
+def fetch_historical_by_cnpj(
+    client: AcessoriasClient,
+    months_back: int = 6,
+    today: Optional[date] = None,
+) -> List[Dict[str, Any]]:
     """
     Busca histórico de deliveries por CNPJ (sem DtLastDH).
     """
@@ -118,20 +152,30 @@ def fetch_historical_by_cnpj(client: AcessoriasClient, months_back: int = 6) ->
         return []
     
     try:
+        # Tuplas leves (id, cnpj, nome) em vez de instâncias ORM; sessão fecha logo
         session = get_session()
-        companies = session.query(Company).all()
-        session.close()
+        try:
+            rows = session.query(Company.id, Company.cnpj, Company.nome).all()
+        finally:
+            session.close()
+
+        # Um CNPJ -> company_id: CNPJs duplicados são consultados uma única vez
+        companies: Dict[str, Tuple[str, str]] = {}
+        for company_id, cnpj, nome in rows:
+            key = cnpj or company_id
+            if key and key not in companies:
+                companies[key] = (company_id, nome)
         
         if not companies:
             log("fetch_deliveries", "INFO", "Nenhuma empresa no banco, pulando histórico")
             return []
         
         # Período: últimos N meses
-        dt_final = date.today()
+        dt_final = today or date.today()
         dt_initial = dt_final - timedelta(days=30 * months_back)
         
-        dt_initial_str = dt_initial.strftime("%Y-%m-%d")
-        dt_final_str = dt_final.strftime("%Y-%m-%d")
+        dt_initial_str = dt_initial.isoformat()
+        dt_final_str = dt_final.isoformat()
         
         log("fetch_deliveries", "INFO", "Buscando histórico por CNPJ",
             total_empresas=len(companies),
@@ -139,14 +183,10 @@ def fetch_historical_by_cnpj(client: AcessoriasClient, months_back: int = 6) ->
         
         aggregated: List[Dict[str, Any]] = []
         
-        for company in companies:
-            cnpj = company.cnpj or company.id
-            if not cnpj:
-                continue
-            
+        for cnpj, (company_id, nome) in companies.items():
             try:
                 log("fetch_deliveries", "DEBUG", "Buscando deliveries",
-                    cnpj=cnpj, empresa=company.nome)
+                    cnpj=cnpj, empresa=nome)
                 
                 rows = client.list_deliveries_by_cnpj(
                     cnpj=cnpj,
@@ -156,7 +196,7 @@ def fetch_historical_by_cnpj(client: AcessoriasClient, months_back: int = 6) ->
                 
                 # Adicionar company_id a cada registro
                 for row in rows:
-                    row["company_id"] = company.id
+                    row["company_id"] = company_id
                 
                 aggregated.extend(rows)
                 
@@ -175,21 +215,23 @@ def fetch_historical_by_cnpj(client: AcessoriasClient, months_back: int = 6) ->
         return []
 
 
-def fetch_delta_listall(client: AcessoriasClient, dt_last_dh: str) -> List[Dict[str, Any]]:
+def fetch_delta_listall(
+    client: AcessoriasClient,
+    dt_last_dh: str,
+    today: Optional[date] = None,
+) -> List[Dict[str, Any]]:
     """
     Busca delta diário via ListAll com DtLastDH.
     """
-    today = date.today()
+    today = today or date.today()
     yesterday = today - timedelta(days=1)
     
-    # Buscar hoje e ontem
-    dates_to_fetch = [yesterday, today]
+    # Buscar hoje e ontem (strings formatadas uma única vez)
+    day_strs = [yesterday.isoformat(), today.isoformat()]
     
     aggregated: List[Dict[str, Any]] = []
     
-    for target_date in dates_to_fetch:
-        date_str = target_date.strftime("%Y-%m-%d")
-        
+    for date_str in day_strs:
         try:
             log("fetch_deliveries", "INFO", "Buscando delta ListAll",
                 data=date_str, dt_last_dh=dt_last_dh)
@@ -223,6 +265,10 @@ def main() -> None:
 
     ensure_dirs()
 
+    # Relógio lido uma única vez por execução
+    today = date.today()
+    now_utc = datetime.now(timezone.utc).replace(microsecond=0)
+
     cfg = load_config()
     acessorias_cfg = cfg.get("acessorias", {})
     deliveries_cfg = cfg.get("deliveries", {})
@@ -246,44 +292,63 @@ def main() -> None:
     # 1. Buscar histórico por CNPJ (se DB disponível)
     if DB_AVAILABLE:
         months_back = deliveries_cfg.get("history_months", 6)
-        historical = fetch_historical_by_cnpj(client, months_back=months_back)
+        historical = fetch_historical_by_cnpj(client, months_back=months_back, today=today)
         aggregated.extend(historical)
         log("fetch_deliveries", "INFO", "Histórico coletado", total=len(historical))
 
     # 2. Buscar delta diário via ListAll
-    dt_last_dh = compute_dt_last_dh(last_sync)
-    delta = fetch_delta_listall(client, dt_last_dh)
+    dt_last_dh = compute_dt_last_dh(last_sync, today=today)
+    delta = fetch_delta_listall(client, dt_last_dh, today=today)
     aggregated.extend(delta)
     log("fetch_deliveries", "INFO", "Delta coletado", total=len(delta))
 
     # Normalizar
-    normalized = [normalize_structure(item) for item in aggregated]
+    normalized = normalize_structures(aggregated)
     
     # Persistir no banco de dados
     if DB_AVAILABLE and normalized:
         try:
             init_db()
             session = get_session()
-            count = bulk_upsert_deliveries(session, normalized)
-            session.close()
+            count = 0
+            try:
+                # Lotes com commit próprio: transações curtas e progresso parcial em caso de falha
+                for start in range(0, len(normalized), UPSERT_CHUNK_SIZE):
+                    batch = normalized[start:start + UPSERT_CHUNK_SIZE]
+                    try:
+                        count += bulk_upsert_deliveries(session, batch)
+                    except Exception as e:
+                        session.rollback()
+                        log("fetch_deliveries", "ERROR", "Erro ao persistir lote",
+                            inicio=start, fim=start + len(batch), error=str(e))
+            finally:
+                session.close()
             log("fetch_deliveries", "DEBUG", "Persistido no banco de dados", total=count)
         except Exception as e:
             log("fetch_deliveries", "ERROR", "Erro ao persistir no banco", error=str(e))
     
-    # Salvar snapshot JSON (fallback)
-    OUTPUT.write_text(json.dumps(normalized, ensure_ascii=False, indent=2), encoding="utf-8")
-    log("fetch_deliveries", "DEBUG", "Salvo deliveries_raw.json", total=len(normalized))
-    
-    # Salvar snapshot para o frontend
+    # Salvar snapshots JSON (fallback + frontend) apenas se o conteúdo mudou
     deliveries_frontend = DATA / "deliveries.json"
-    deliveries_frontend.write_text(json.dumps(normalized, ensure_ascii=False, indent=2), encoding="utf-8")
-    log("fetch_deliveries", "DEBUG", "Salvo deliveries.json para frontend", total=len(normalized))
+    serialized = json.dumps(normalized, ensure_ascii=False, indent=2).encode("utf-8")
+    payload_hash = blake2b(serialized, digest_size=16).hexdigest()
+    previous_hash = (sync_state.get("deliveries") or {}).get("payload_hash")
+
+    if payload_hash == previous_hash and OUTPUT.exists() and deliveries_frontend.exists():
+        log("fetch_deliveries", "DEBUG", "Snapshots inalterados, escrita ignorada", total=len(normalized))
+    else:
+        write_snapshots(serialized, OUTPUT, deliveries_frontend)
+        log("fetch_deliveries", "DEBUG", "Salvo deliveries_raw.json e deliveries.json", total=len(normalized))
 
     # Atualizar sync state
-    now_utc = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
-    sync_state.setdefault("deliveries", {})["last_sync"] = now_utc
+    last_sync_iso = now_utc.isoformat()
+    # Relê antes de gravar: outros coletores (api) podem ter atualizado as
+    # próprias chaves enquanto este rodava
+    sync_state = load_sync_state()
+    deliveries_state = sync_state.setdefault("deliveries", {})
+    deliveries_state["last_sync"] = last_sync_iso
+    deliveries_state["payload_hash"] = payload_hash
     save_sync_state(sync_state)
-    log("fetch_deliveries", "INFO", "Atualizado sync", last_sync=now_utc)
+    log("fetch_deliveries", "INFO", "Atualizado sync", last_sync=last_sync_iso)
 
 
 if __name__ == "__main__":
@@ -4,9 +4,10 @@ Lê Gmail (readonly), extrai eventos dos e-mails padronizados e gera data/events
 Regras por regex para mapear Assunto/Corpo em categoria/subtipo/status
 """
 import os, json, base64, re
+from hashlib import blake2b
 from pathlib import Path
-from typing import Any, Dict, List, Optional
-from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 from google.oauth2.credentials import Credentials
@@ -14,6 +15,8 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 
+from scripts.utils.email_events import map_event
+
 ROOT = Path(__file__).resolve().parents[1]
 DATA = ROOT / "data"
 EVENTS_EMAIL = DATA / "events_email.json"
@@ -38,10 +41,13 @@ def auth_gmail(creds_path: str, token_path: str, scopes: List[str]):
     return build("gmail", "v1", credentials=creds, cache_discovery=False)
 
 RE_ID = re.compile(r"\(ID\s*(\d+)\)")
-RE_CNPJ = re.compile(r"\b\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2}\b")
-RE_RESP = re.compile(r"Respons[aá]vel\s*:\s*(.+)")
-RE_TEMPO = re.compile(r"Tempo do processo\s*:\s*(\d+)")
-RE_DATA = re.compile(r"Data (?:de preenchimento|do processo)\s*:\s*(\d{2}/\d{2}/\d{4})")
+# Padrões do corpo operam direto sobre os bytes decodificados do base64 (UTF-8)
+RE_CNPJ = re.compile(rb"\b\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2}\b")
+RE_RESP = re.compile(r"Respons(?:a|á)vel\s*:\s*(.+)".encode("utf-8"))
+RE_TEMPO = re.compile(rb"Tempo do processo\s*:\s*(\d+)")
+RE_DATA = re.compile(rb"Data (?:de preenchimento|do processo)\s*:\s*(\d{2}/\d{2}/\d{4})")
+RE_SUBJ_EMPRESA = re.compile(r"\(ID.*$")
+RE_SUBJ_DATA = re.compile(r"(\d{2}/\d{2}/\d{4})")
 
 def parse_subject(subj: str) -> Dict[str, Optional[str]]:
     # Formato: <Regime/Atividade> | <Evento> — <Empresa> (ID 123) — <Data>
@@ -59,60 +65,69 @@ def parse_subject(subj: str) -> Dict[str, Optional[str]]:
         # empresa + (ID NNN)
         if len(parts) >= 2:
             emp = parts[1].strip()
-            d["empresa"] = re.sub(r"\(ID.*$", "", emp).strip()
+            d["empresa"] = RE_SUBJ_EMPRESA.sub("", emp).strip()
             m = RE_ID.search(parts[1])
             if m:
                 d["proc_id"] = m.group(1)
         # data
         if len(parts) >= 3:
-            m = re.search(r"(\d{2}/\d{2}/\d{4})", parts[2])
+            m = RE_SUBJ_DATA.search(parts[2])
             if m:
                 d["data"] = m.group(1)
     except Exception:
         pass
     return d
 
-def map_event(evento_raw: str, body: str) -> Dict[str, Optional[str]]:
-    text = f"{evento_raw}\n{body}".lower()
-    def has(x: str): return x.lower() in text
-
-    # EFD-Reinf
-    if "efd-reinf" in text or "efd reinf" in text:
-        if "obrigat" in text:
-            return {"categoria": "efd_reinf", "subtipo": None, "status": "Obrigatória"}
-        if "dispens" in text:
-            return {"categoria": "efd_reinf", "subtipo": None, "status": "Dispensada"}
-    # EFD Contribuições
-    if "efd contribui" in text:
-        if "obrigat" in text:
-            return {"categoria": "efd_contrib", "subtipo": None, "status": "Obrigatória"}
-        if "dispens" in text:
-            return {"categoria": "efd_contrib", "subtipo": None, "status": "Dispensada"}
-    # MIT preenchida
-    if "mit preenchida" in text:
-        return {"categoria": "mit", "subtipo": "preenchida", "status": "OK"}
-    # DIFAL
-    if "difal" in text:
-        if "consumo" in text or "imobiliz" in text:
-            return {"categoria": "difal", "subtipo": "consumo_imobilizado", "status": "Obrigatório"}
-        if "comercializ" in text:
-            return {"categoria": "difal", "subtipo": "comercializacao", "status": "Incidência confirmada"}
-    # Fora do DAS
-    if "fora do das" in text:
-        if "iss e icms" in text:
-            return {"categoria": "fora_das", "subtipo": "ISS_ICMS", "status": "Emitir guias"}
-        if "icms" in text:
-            return {"categoria": "fora_das", "subtipo": "ICMS", "status": "Emitir guia estadual"}
-        if "iss" in text:
-            return {"categoria": "fora_das", "subtipo": "ISS", "status": "Emitir guia municipal"}
-    # Finalização
-    if "processo fiscal finalizado" in text or "controle mensal — finalizado" in text or "controle mensal - finalizado" in text:
-        return {"categoria": "finalizacao", "subtipo": None, "status": "Finalizado"}
-
-    return {"categoria": None, "subtipo": None, "status": None}
-
-def b64_to_text(b64: str) -> str:
-    return base64.urlsafe_b64decode(b64.encode("utf-8")).decode("utf-8", errors="ignore")
+def parse_email_message(msg: Dict[str, Any]) -> Tuple[str, str, bytes, Optional[str]]:
+    """Extrai (assunto, data do e-mail, bytes do corpo text/plain, hash do corpo) de uma mensagem Gmail."""
+    payload = msg.get("payload") or {}
+    hdr = {h["name"]: h["value"] for h in payload.get("headers", ())}
+    subj = hdr.get("Subject", "")
+    internal_date = int(msg.get("internalDate", 0)) // 1000
+    email_date = datetime.fromtimestamp(internal_date, tz=timezone.utc).date().isoformat()
+
+    # corpo (text/plain preferencial)
+    parts = payload.get("parts")
+    if parts:
+        part = next(
+            (p for p in parts if p.get("mimeType") == "text/plain" and "data" in p.get("body", {})),
+            None,
+        )
+        data = part["body"]["data"] if part else None
+    else:
+        data = payload.get("body", {}).get("data")
+    if not data:
+        return subj, email_date, b"", None
+    # Corpo fica em bytes: regex e hash trabalham sem decodificar a mensagem inteira
+    raw = base64.urlsafe_b64decode(data.encode("utf-8"))
+    body_hash = blake2b(raw, digest_size=16).hexdigest()
+    return subj, email_date, raw, body_hash
+
+BATCH_SIZE = 100  # limite de sub-requisições por batch na Gmail API
+
+def fetch_messages(service, ids: List[str], **get_kwargs) -> Iterator[Dict[str, Any]]:
+    """Busca mensagens em lotes (multipart/mixed), emitindo-as lote a lote na ordem de ``ids``.
+
+    Só um lote fica em memória por vez; as mensagens completas nunca são acumuladas.
+    """
+    for start in range(0, len(ids), BATCH_SIZE):
+        chunk = ids[start:start + BATCH_SIZE]
+        fetched: Dict[str, Dict[str, Any]] = {}
+
+        def _on_msg(request_id: str, response: Dict[str, Any], exception: Exception) -> None:
+            if exception is not None:
+                print(f"[fetch_email] falha ao buscar mensagem {request_id}: {exception}")
+                return
+            fetched[request_id] = response
+
+        batch = service.new_batch_http_request(callback=_on_msg)
+        for mid in chunk:
+            batch.add(service.users().messages().get(userId="me", id=mid, **get_kwargs), request_id=mid)
+        batch.execute()
+        for mid in chunk:
+            msg = fetched.pop(mid, None)
+            if msg is not None:
+                yield msg
 
 def main():
     load_dotenv()
@@ -127,43 +142,37 @@ def main():
     msgs_list = service.users().messages().list(userId="me", q=query, maxResults=max_results).execute()
     ids = [m["id"] for m in msgs_list.get("messages", [])]
 
+    # Fase 1: só cabeçalhos; descarta e-mails fora do padrão de assunto antes de baixar o corpo
+    candidates = []
+    for msg in fetch_messages(service, ids, format="metadata", metadataHeaders=["Subject", "Date"]):
+        headers = {h["name"]: h["value"] for h in msg.get("payload", {}).get("headers", ())}
+        meta = parse_subject(headers.get("Subject", ""))
+        if meta.get("proc_id") or meta.get("evento_raw"):
+            candidates.append(msg["id"])
+
     events: List[Dict[str, Any]] = []
-    for mid in ids:
-        msg = service.users().messages().get(userId="me", id=mid, format="full").execute()
-        headers = {h["name"]: h["value"] for h in msg["payload"]["headers"]}
-        subj = headers.get("Subject", "")
-        internal_date = int(msg.get("internalDate", 0)) // 1000
-        email_date = datetime.utcfromtimestamp(internal_date).strftime("%Y-%m-%d")
-
-        # corpo (text/plain preferencial)
-        body_text = ""
-        parts = msg["payload"].get("parts")
-        if parts:
-            for p in parts:
-                if p.get("mimeType") == "text/plain" and "data" in p.get("body", {}):
-                    body_text = b64_to_text(p["body"]["data"])
-                    break
-        else:
-            if "data" in msg["payload"].get("body", {}):
-                body_text = b64_to_text(msg["payload"]["body"]["data"])
+    # Fase 2: corpo completo apenas dos sobreviventes
+    for msg in fetch_messages(service, candidates, format="full"):
+        mid = msg["id"]
+        subj, email_date, body, body_hash = parse_email_message(msg)
 
         meta = parse_subject(subj)
-        mapping = map_event(meta.get("evento_raw") or "", body_text)
+        mapping = map_event(meta.get("evento_raw") or "", body)
 
         if mapping["categoria"]:
             cnpj = None
-            m = RE_CNPJ.search(body_text)
-            if m: cnpj = m.group(0)
+            m = RE_CNPJ.search(body)
+            if m: cnpj = m.group(0).decode("ascii")
             resp = None
-            m = RE_RESP.search(body_text)
-            if m: resp = m.group(1).strip()
+            m = RE_RESP.search(body)
+            if m: resp = m.group(1).decode("utf-8", errors="ignore").strip()
             tempo = None
-            m = RE_TEMPO.search(body_text)
+            m = RE_TEMPO.search(body)
             if m: tempo = int(m.group(1))
             data_evento = meta.get("data")
             if not data_evento:
-                m = RE_DATA.search(body_text)
-                if m: data_evento = m.group(1)
+                m = RE_DATA.search(body)
+                if m: data_evento = m.group(1).decode("ascii")
 
             # Inferir competência pela data do evento
             competencia = None
@@ -188,7 +197,7 @@ def main():
                 "passo_status": None,
                 "bloqueante": None,
                 "email_id": mid,
-                "body_hash": None
+                "body_hash": body_hash
             }
             events.append(evt)
 
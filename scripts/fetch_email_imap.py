@@ -14,23 +14,28 @@ import os
 import json
 import imaplib
 import re
+from concurrent.futures import ThreadPoolExecutor
 from email import message_from_bytes
 from email.header import decode_header, make_header
 from email.message import Message
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional
-from hashlib import sha1
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from hashlib import blake2b
 
 from dotenv import load_dotenv
 
+from scripts.utils.date_helpers import br_to_iso
+from scripts.utils.email_events import map_event
 from scripts.utils.logger import log
+from scripts.utils.optional import orjson
 
 # --- env/config/paths ---------------------------------------------------------
 ROOT = Path(__file__).resolve().parents[1]
 DATA = ROOT / "data"
 OUT_EVENTS = DATA / "events_email.json"
 OUT_RAW = DATA / "emails_raw.json"
+IMAP_CURSOR = DATA / "imap_cursor.json"
 CONFIG = ROOT / "scripts" / "config.json"
 
 load_dotenv(dotenv_path=ROOT / ".env", override=True)
@@ -41,6 +46,9 @@ RE_CNPJ = re.compile(r"\b\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2}\b")
 RE_RESP = re.compile(r"Respons[aá]vel\s*:\s*(.+)")
 RE_TEMPO= re.compile(r"Tempo do processo\s*:\s*(\d+)")
 RE_DATA = re.compile(r"Data (?:de preenchimento|do processo)\s*:\s*(\d{2}/\d{2}/\d{4})")
+RE_UID  = re.compile(rb"UID (\d+)")
+_RE_ID_TAIL = re.compile(r"\(ID.*$")
+_RE_DATE_SHORT = re.compile(r"\d{2}/\d{2}/\d{4}")
 
 
 # --- helpers ------------------------------------------------------------------
@@ -50,6 +58,46 @@ def load_cfg() -> Dict[str, Any]:
     return json.loads(CONFIG.read_text(encoding="utf-8"))
 
 
+def _dumps_item(item: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(item, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(item, ensure_ascii=False, indent=2)
+
+
+class _JsonArrayWriter:
+    """
+    Grava uma lista JSON item a item (mesmo layout de ``json.dumps(..., indent=2)``)
+    num arquivo temporário, sem montar a string inteira em memória. O destino só é
+    substituído ao sair do ``with`` sem erro; numa falha o snapshot anterior fica.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.tmp = path.with_name(path.name + ".tmp")
+        self.count = 0
+        self._fp = None
+
+    def __enter__(self) -> "_JsonArrayWriter":
+        self._fp = self.tmp.open("w", encoding="utf-8")
+        self._fp.write("[")
+        return self
+
+    def write(self, item: Any) -> None:
+        # quebras de linha reais só existem na estrutura (strings vêm escapadas)
+        chunk = _dumps_item(item).replace("\n", "\n  ")
+        self._fp.write(("," if self.count else "") + "\n  " + chunk)
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self._fp.write("\n]" if self.count else "]")
+        self._fp.close()
+        if exc_type is None:
+            os.replace(self.tmp, self.path)
+        else:
+            self.tmp.unlink(missing_ok=True)
+        return False
+
+
 def decode_subj(raw: Optional[str]) -> str:
     try:
         return str(make_header(decode_header(raw or "")))
@@ -57,20 +105,38 @@ def decode_subj(raw: Optional[str]) -> str:
         return raw or ""
 
 
+def _decode_part(part: Message) -> str:
+    payload = part.get_payload(decode=True) or b""
+    try:
+        return payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+    except LookupError:  # charset desconhecido no cabeçalho
+        return payload.decode("utf-8", errors="replace")
+
+
 def get_text_message(msg: Message) -> str:
     parts: List[str] = []
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "text/plain" and part.get_content_disposition() != "attachment":
-                payload = part.get_payload(decode=True) or b""
-                parts.append(payload.decode(part.get_content_charset() or "utf-8", errors="replace"))
-    else:
-        if msg.get_content_type() == "text/plain":
-            payload = msg.get_payload(decode=True) or b""
-            parts.append(payload.decode(msg.get_content_charset() or "utf-8", errors="replace"))
+    # Pilha explícita na mesma ordem do msg.walk(), sem geradores recursivos;
+    # folhas que não são texto são descartadas sem olhar o payload
+    stack = [msg]
+    while stack:
+        part = stack.pop()
+        if part.is_multipart():
+            stack.extend(reversed(part.get_payload()))
+            continue
+        if part.get_content_type() == "text/plain" and part.get_content_disposition() != "attachment":
+            parts.append(_decode_part(part))
     return "\n".join(p.strip() for p in parts if p)
 
 
+def _header_may_match(raw: str, needles: List[str]) -> bool:
+    # Cabeçalho cru sem RFC 2047 (=?charset?...?=) já é o texto final: se nenhum
+    # filtro aparece nele, dá para descartar a mensagem sem decodificar nada
+    if "=?" in raw:
+        return True
+    low = raw.lower()
+    return any(n in low for n in needles)
+
+
 def parse_subject(subj: str) -> Dict[str, Optional[str]]:
     # Ex.: "<Regime/Atividade> | <Evento> — <Empresa> (ID 12345) — <Data dd/mm/aaaa>"
     d = {"regime": None, "evento_raw": None, "empresa": None, "proc_id": None, "data": None}
@@ -85,50 +151,114 @@ def parse_subject(subj: str) -> Dict[str, Optional[str]]:
         d["evento_raw"] = evento
         if len(parts) >= 2:
             emp = parts[1].strip()
-            d["empresa"] = re.sub(r"\(ID.*$", "", emp).strip()
+            d["empresa"] = _RE_ID_TAIL.sub("", emp).strip()
             m = RE_ID.search(parts[1])
             if m:
                 d["proc_id"] = m.group(1)
         if len(parts) >= 3:
-            m = re.search(r"(\d{2}/\d{2}/\d{4})", parts[2])
+            m = _RE_DATE_SHORT.search(parts[2])
             if m:
-                d["data"] = m.group(1)
+                d["data"] = m.group(0)
     except Exception:
         pass
     return d
 
 
-def map_event(evento_raw: str, body: str) -> Dict[str, Optional[str]]:
-    text = f"{evento_raw}\n{body}".lower()
-    if "efd-reinf" in text or "efd reinf" in text:
-        if "obrigat" in text:
-            return {"categoria": "efd_reinf", "subtipo": None, "status": "Obrigatória"}
-        if "dispens" in text:
-            return {"categoria": "efd_reinf", "subtipo": None, "status": "Dispensada"}
-    if "efd contrib" in text:
-        if "obrigat" in text:
-            return {"categoria": "efd_contrib", "subtipo": None, "status": "Obrigatória"}
-        if "dispens" in text:
-            return {"categoria": "efd_contrib", "subtipo": None, "status": "Dispensada"}
-    if "mit preenchida" in text:
-        return {"categoria": "mit", "subtipo": "preenchida", "status": "OK"}
-    if "difal" in text:
-        if "consumo" in text or "imobiliz" in text:
-            return {"categoria": "difal", "subtipo": "consumo_imobilizado", "status": "Obrigatório"}
-        if "comercializ" in text:
-            return {"categoria": "difal", "subtipo": "comercializacao", "status": "Incidência confirmada"}
-        if "ambos" in text:
-            return {"categoria": "difal", "subtipo": "ambos", "status": "Incidência confirmada"}
-    if "fora do das" in text:
-        if "iss e icms" in text:
-            return {"categoria": "fora_das", "subtipo": "ISS_ICMS", "status": "Emitir guias"}
-        if "icms" in text:
-            return {"categoria": "fora_das", "subtipo": "ICMS", "status": "Emitir guia estadual"}
-        if "iss" in text:
-            return {"categoria": "fora_das", "subtipo": "ISS", "status": "Emitir guia municipal"}
-    if "processo fiscal finalizado" in text or "controle mensal — finalizado" in text or "controle mensal - finalizado" in text:
-        return {"categoria": "finalizacao", "subtipo": None, "status": "Finalizado"}
-    return {"categoria": None, "subtipo": None, "status": None}
+class _PipelinedFetchMixin:
+    """
+    UID FETCH com pipelining (RFC 3501 §5.5): envia vários comandos antes de ler
+    qualquer resposta e depois drena as respostas tagged na ordem.
+    """
+
+    pipeline_ok = True
+
+    def fetch_pipelined(self, uid_sets: List[bytes], message_parts: str):
+        tags = [self._command("UID", "FETCH", uid_set, message_parts) for uid_set in uid_sets]
+        typ = "OK"
+        failure: Optional[Exception] = None
+        for tag in tags:
+            # Drena todas as tags mesmo após erro para não deixar respostas pendentes
+            try:
+                tag_typ, _ = self._command_complete("UID", tag)
+                if tag_typ != "OK":
+                    typ = tag_typ
+            except self.abort:
+                raise
+            except self.error as exc:
+                failure = failure or exc
+        if failure is not None:
+            self.untagged_responses.pop("FETCH", None)
+            raise failure
+        return self._untagged_response(typ, [None], "FETCH")
+
+
+class PipelinedIMAP4(_PipelinedFetchMixin, imaplib.IMAP4):
+    pass
+
+
+class PipelinedIMAP4_SSL(_PipelinedFetchMixin, imaplib.IMAP4_SSL):
+    pass
+
+
+def _pair_by_uid(data: List[Any], window: List[List[bytes]]) -> List[Tuple[bytes, bytes]]:
+    # Resposta alterna (b'<seq> (UID <uid> RFC822 {n}', bytes) com o fechamento b')';
+    # alguns servidores mandam o UID depois do literal, no fechamento (b' UID <uid>)')
+    by_uid: Dict[bytes, bytes] = {}
+    data = data or []
+    for idx, item in enumerate(data):
+        if not (isinstance(item, tuple) and len(item) >= 2):
+            continue
+        m = RE_UID.search(item[0])
+        if m is None and idx + 1 < len(data) and isinstance(data[idx + 1], bytes):
+            m = RE_UID.search(data[idx + 1])
+        if m is not None:
+            by_uid[m.group(1)] = item[1]
+    return [(uid, by_uid[uid]) for chunk in window for uid in chunk if uid in by_uid]
+
+
+def _fetch_window(M: imaplib.IMAP4, window: List[List[bytes]]) -> List[Tuple[bytes, bytes]]:
+    """Busca uma janela de lotes: pipelined quando suportado, senão um UID FETCH por lote."""
+    uid_sets = [b",".join(chunk) for chunk in window]
+    if getattr(M, "pipeline_ok", False) and len(uid_sets) > 1:
+        try:
+            typ, data = M.fetch_pipelined(uid_sets, "(UID RFC822)")
+            return _pair_by_uid(data, window) if typ == "OK" else []
+        except M.abort:
+            raise
+        except M.error as exc:
+            log("fetch_email_imap", "WARNING", "Pipelining recusado; usando FETCH sequencial", error=str(exc))
+            M.pipeline_ok = False
+
+    data: List[Any] = []
+    for uid_set in uid_sets:
+        typ, chunk_data = M.uid("FETCH", uid_set, "(UID RFC822)")
+        if typ == "OK" and chunk_data:
+            data.extend(chunk_data)
+    return _pair_by_uid(data, window)
+
+
+def iter_raw_messages(
+    M: imaplib.IMAP4,
+    uids: List[bytes],
+    bulk_size: int,
+    pipeline_depth: int = 1,
+) -> Iterator[Tuple[bytes, bytes]]:
+    """
+    Busca mensagens (por UID) em lotes de ``bulk_size`` (N/bulk_size round-trips em
+    vez de N), com até ``pipeline_depth`` UID FETCH em voo. A janela seguinte é
+    baixada em background enquanto a atual é processada.
+    """
+    chunks = [uids[i:i + bulk_size] for i in range(0, len(uids), bulk_size)]
+    windows = [chunks[i:i + pipeline_depth] for i in range(0, len(chunks), pipeline_depth)]
+    if not windows:
+        return
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(_fetch_window, M, windows[0])
+        for nxt in windows[1:] + [None]:
+            fetched = pending.result()
+            if nxt is not None:
+                pending = pool.submit(_fetch_window, M, nxt)
+            yield from fetched
 
 
 def imap_since(days: int) -> str:
@@ -136,6 +266,45 @@ def imap_since(days: int) -> str:
     return dt.strftime("%d-%b-%Y")
 
 
+def load_cursor(folder: str, uidvalidity: Optional[str]) -> Optional[int]:
+    """Último UID processado na pasta; só vale se o UIDVALIDITY não mudou."""
+    if not (IMAP_CURSOR.exists() and uidvalidity):
+        return None
+    try:
+        cursor = json.loads(IMAP_CURSOR.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if cursor.get("folder") != folder or str(cursor.get("uidvalidity")) != uidvalidity:
+        return None
+    try:
+        return int(cursor["last_uid"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def save_cursor(folder: str, uidvalidity: Optional[str], last_uid: int) -> None:
+    if not uidvalidity:
+        return
+    # tmp + os.replace: um crash no meio da escrita não deixa o cursor truncado
+    # (o que faria a próxima execução varrer a caixa inteira de novo)
+    tmp = IMAP_CURSOR.with_name(IMAP_CURSOR.name + ".tmp")
+    tmp.write_text(
+        json.dumps({"folder": folder, "uidvalidity": uidvalidity, "last_uid": last_uid}, indent=2),
+        encoding="utf-8",
+    )
+    os.replace(tmp, IMAP_CURSOR)
+
+
+def _load_previous(path: Path) -> List[Dict[str, Any]]:
+    if not path.exists():
+        return []
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return []
+    return data if isinstance(data, list) else []
+
+
 # --- main ---------------------------------------------------------------------
 def main() -> None:
     cfg = load_cfg()
@@ -156,14 +325,19 @@ def main() -> None:
     max_messages = int(cfg.get("imap", {}).get("max_messages", 2000))
     subject_kw   = cfg.get("imap", {}).get("subject_keywords", [])
     from_filters = cfg.get("imap", {}).get("from_filters", [])
+    bulk_size    = max(1, int(cfg.get("imap", {}).get("bulk_size", 100)))
+    pipeline     = max(1, int(cfg.get("imap", {}).get("pipeline_depth", 4)))
+    incremental  = bool(cfg.get("imap", {}).get("incremental", True))
+    subject_kw   = [kw.lower() for kw in subject_kw]
+    from_filters = [f.lower() for f in from_filters]
 
     log("fetch_email_imap", "INFO", "Conectando", host=host, folder=folder)
 
     M: imaplib.IMAP4 | imaplib.IMAP4_SSL
     if use_ssl:
-        M = imaplib.IMAP4_SSL(host, port)
+        M = PipelinedIMAP4_SSL(host, port)
     else:
-        M = imaplib.IMAP4(host, port)
+        M = PipelinedIMAP4(host, port)
         try:
             M.starttls()
         except Exception as exc:
@@ -174,105 +348,127 @@ def main() -> None:
         typ, _ = M.select(folder)
         if typ != "OK":
             raise RuntimeError(f"IMAP select falhou: {typ}")
+        _, validity = M.response("UIDVALIDITY")
+        uidvalidity = validity[0].decode() if validity and validity[0] else None
 
-        since = imap_since(search_days)
-        typ, data = M.search(None, f'(SINCE "{since}")')
+        last_uid = load_cursor(folder, uidvalidity) if incremental else None
+        if last_uid is not None:
+            # Só o que chegou depois da última execução
+            typ, data = M.uid("SEARCH", None, f"UID {last_uid + 1}:*")
+        else:
+            since = imap_since(search_days)
+            typ, data = M.uid("SEARCH", None, f'(SINCE "{since}")')
         if typ != "OK":
             raise RuntimeError(f"IMAP search falhou: {typ}")
 
-        ids = data[0].split()
+        ids = data[0].split() if data and data[0] else []
+        if last_uid is not None:
+            # "N:*" sempre inclui a última mensagem, mesmo com UID < N
+            ids = [uid for uid in ids if int(uid) > last_uid]
         ids = ids[-max_messages:]
 
-        events: List[Dict[str, Any]] = []
-        raws: List[Dict[str, Any]] = []
-
-        log("fetch_email_imap", "INFO", "Processando mensagens", total=len(ids))
-
-        for num in reversed(ids):
-            typ, msg_data = M.fetch(num, "(RFC822)")
-            if typ != "OK" or not msg_data or not msg_data[0]:
-                continue
-            raw = msg_data[0][1]
-            email_msg = message_from_bytes(raw)
-            assert isinstance(email_msg, Message)
-
-            subj = decode_subj(email_msg.get("Subject", ""))
-            from_addr = str(make_header(decode_header(email_msg.get("From", ""))))
-            to_addr = str(make_header(decode_header(email_msg.get("To", ""))))
-            date_hdr = email_msg.get("Date")
-
-            # Filtros do config
-            if from_filters and not any(f.lower() in from_addr.lower() for f in from_filters):
-                continue
-            if subject_kw and not any(kw.lower() in subj.lower() for kw in subject_kw):
-                continue
-
-            body = get_text_message(email_msg)
-            body_hash = sha1(body.encode("utf-8", errors="ignore")).hexdigest() if body else None
-
-            # RAW compacto (para passar no verificador e auditoria leve)
-            raws.append({
-                "uid": num.decode() if isinstance(num, bytes) else str(num),
-                "subject": subj,
-                "from": from_addr,
-                "to": to_addr,
-                "date": date_hdr,
-                "snippet": (body[:300] + "…") if body and len(body) > 300 else body,
-            })
-
-            # Evento mapeado
-            meta = parse_subject(subj)
-            mapping = map_event(meta.get("evento_raw") or "", body)
-            if not mapping["categoria"]:
-                continue
-
-            cnpj_match = RE_CNPJ.search(body)
-            cnpj = cnpj_match.group(0) if cnpj_match else None
-            resp_match = RE_RESP.search(body)
-            resp = resp_match.group(1).strip() if resp_match else None
-
-            data_evento = meta.get("data")
-            if not data_evento:
-                m = RE_DATA.search(body)
-                if m:
-                    data_evento = m.group(1)
-
-            data_evento_iso = None
-            if data_evento:
-                try:
-                    data_evento_iso = datetime.strptime(data_evento, "%d/%m/%Y").strftime("%Y-%m-%d")
-                except ValueError:
-                    data_evento_iso = None
-
-            competencia = data_evento_iso[:7] if data_evento_iso else None
-
-            events.append({
-                "source": "email",
-                "proc_id": meta.get("proc_id"),
-                "empresa": meta.get("empresa"),
-                "cnpj": cnpj,
-                "regime": meta.get("regime"),
-                "atividade": None,
-                "categoria": mapping["categoria"],
-                "subtipo": mapping.get("subtipo"),
-                "status": mapping.get("status"),
-                "responsavel": resp,
-                "prazo": None,
-                "data_evento": data_evento_iso,
-                "competencia": competencia,
-                "passo_status": None,
-                "bloqueante": None,
-                "email_id": num.decode() if isinstance(num, bytes) else str(num),
-                "body_hash": body_hash,
-            })
-
-        # Escritas
-        DATA.mkdir(parents=True, exist_ok=True)
-        OUT_RAW.write_text(json.dumps(raws, ensure_ascii=False, indent=2), encoding="utf-8")
-        OUT_EVENTS.write_text(json.dumps(events, ensure_ascii=False, indent=2), encoding="utf-8")
+        # Execução incremental: o que já foi processado continua nos arquivos,
+        # atrás das mensagens novas e limitado a max_messages
+        prev_raws: List[Dict[str, Any]] = []
+        prev_events: List[Dict[str, Any]] = []
+        if last_uid is not None:
+            prev_raws = _load_previous(OUT_RAW)
+            prev_events = _load_previous(OUT_EVENTS)
+
+        log("fetch_email_imap", "INFO", "Processando mensagens",
+            total=len(ids), incremental=last_uid is not None, last_uid=last_uid)
+
+        # Escritas incrementais: cada item vai para disco assim que é produzido
+        with _JsonArrayWriter(OUT_RAW) as raws, _JsonArrayWriter(OUT_EVENTS) as events:
+            for num, raw in iter_raw_messages(M, list(reversed(ids)), bulk_size, pipeline):
+                email_msg = message_from_bytes(raw)
+                assert isinstance(email_msg, Message)
+
+                raw_from = str(email_msg.get("From", ""))
+                raw_subj = str(email_msg.get("Subject", ""))
+
+                # Filtros do config: primeiro no cabeçalho cru, só decodifica se puder casar
+                if from_filters and not _header_may_match(raw_from, from_filters):
+                    continue
+                if subject_kw and not _header_may_match(raw_subj, subject_kw):
+                    continue
+
+                from_addr = str(make_header(decode_header(raw_from)))
+                if from_filters and not any(f in from_addr.lower() for f in from_filters):
+                    continue
+                subj = decode_subj(raw_subj)
+                if subject_kw and not any(kw in subj.lower() for kw in subject_kw):
+                    continue
+                to_addr = str(make_header(decode_header(email_msg.get("To", ""))))
+                date_hdr = email_msg.get("Date")
+
+                body = get_text_message(email_msg)
+                body_hash = blake2b(body.encode("utf-8", errors="ignore"), digest_size=16).hexdigest() if body else None
+
+                # RAW compacto (para passar no verificador e auditoria leve)
+                raws.write({
+                    "uid": num.decode() if isinstance(num, bytes) else str(num),
+                    "subject": subj,
+                    "from": from_addr,
+                    "to": to_addr,
+                    "date": date_hdr,
+                    "snippet": (body[:300] + "…") if body and len(body) > 300 else body,
+                })
+
+                # Evento mapeado
+                meta = parse_subject(subj)
+                mapping = map_event(meta.get("evento_raw") or "", body)
+                if not mapping["categoria"]:
+                    continue
+
+                cnpj_match = RE_CNPJ.search(body)
+                cnpj = cnpj_match.group(0) if cnpj_match else None
+                resp_match = RE_RESP.search(body)
+                resp = resp_match.group(1).strip() if resp_match else None
+
+                data_evento = meta.get("data")
+                if not data_evento:
+                    m = RE_DATA.search(body)
+                    if m:
+                        data_evento = m.group(1)
+
+                data_evento_iso = br_to_iso(data_evento) if data_evento else None
+
+                competencia = data_evento_iso[:7] if data_evento_iso else None
+
+                events.write({
+                    "source": "email",
+                    "proc_id": meta.get("proc_id"),
+                    "empresa": meta.get("empresa"),
+                    "cnpj": cnpj,
+                    "regime": meta.get("regime"),
+                    "atividade": None,
+                    "categoria": mapping["categoria"],
+                    "subtipo": mapping.get("subtipo"),
+                    "status": mapping.get("status"),
+                    "responsavel": resp,
+                    "prazo": None,
+                    "data_evento": data_evento_iso,
+                    "competencia": competencia,
+                    "passo_status": None,
+                    "bloqueante": None,
+                    "email_id": num.decode() if isinstance(num, bytes) else str(num),
+                    "body_hash": body_hash,
+                })
+
+            kept_uids = set()
+            for item in prev_raws[:max(0, max_messages - raws.count)]:
+                kept_uids.add(item.get("uid"))
+                raws.write(item)
+            for item in prev_events:
+                if item.get("email_id") in kept_uids:
+                    events.write(item)
+
+        if ids:
+            save_cursor(folder, uidvalidity, max(int(uid) for uid in ids))
 
         log("fetch_email_imap", "INFO", "Arquivos gerados",
-            emails_raw=len(raws), events=len(events),
+            emails_raw=raws.count, events=events.count,
             raw_path=str(OUT_RAW), events_path=str(OUT_EVENTS))
 
     finally:
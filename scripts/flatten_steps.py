@@ -2,11 +2,17 @@
 from __future__ import annotations
 
 import json
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Pattern, Tuple, Union
 
+from scripts.utils.date_helpers import br_to_iso
 from scripts.utils.logger import log
+from scripts.utils.optional import ijson, orjson
 
 ROOT = Path(__file__).resolve().parents[1]
 DATA = ROOT / "data"
@@ -15,20 +21,70 @@ DELIVERIES_FILE = DATA / "deliveries_raw.json"
 EVENTS_API = DATA / "events_api.json"
 RULES_PATH = ROOT / "scripts" / "rules.json"
 
+# Abaixo disso o custo de subir os workers supera o ganho do paralelismo
+PARALLEL_MIN_PROCESSES = 2000
+# Limite do cache nome -> regra (os nomes de passos se repetem entre processos)
+MATCH_CACHE_SIZE = 4096
+
 
 def load_json(p: Path) -> Any:
     if not p.exists():
         return []
+    if orjson is not None:
+        return orjson.loads(p.read_bytes())
     return json.loads(p.read_text(encoding="utf-8"))
 
 
-def match_rule(name: str, rules: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
-    low = (name or "").lower()
-    for rule in rules:
-        needle = rule.get("contains", "").lower()
-        if needle and needle in low:
-            return rule
-    return None
+def dump_json(p: Path, payload: Any) -> None:
+    if orjson is not None:
+        p.write_bytes(orjson.dumps(payload, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        return
+    p.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+def iter_deliveries(p: Path) -> Iterator[Dict[str, Any]]:
+    """Itera as deliveries de um snapshot JSON sem materializar a lista inteira."""
+    if not p.exists():
+        return
+    if ijson is None:
+        yield from load_json(p)
+        return
+    with p.open("rb") as fp:
+        yield from ijson.items(fp, "item", use_float=True)
+
+
+RuleMatcher = Tuple[Optional[Pattern[str]], List[Dict[str, Any]], Dict[str, Optional[Dict[str, Any]]]]
+
+
+def compile_rules(rules: List[Dict[str, Any]]) -> RuleMatcher:
+    """
+    Compila os ``contains`` das regras numa única regex. Cada alternativa fica
+    dentro de um lookahead, então em cada posição vence a primeira regra (na
+    ordem do rules.json) que casa ali; o menor índice entre as posições é a
+    mesma regra que o laço original devolveria. O terceiro item é o cache de
+    resultados por nome, já que os mesmos passos aparecem em todos os processos.
+    """
+    active = [rule for rule in rules if rule.get("contains")]
+    if not active:
+        return None, [], {}
+    alternation = "|".join(f"({re.escape(rule['contains'].lower())})" for rule in active)
+    return re.compile(f"(?=(?:{alternation}))"), active, {}
+
+
+def match_rule(name: str, rules: Union[RuleMatcher, List[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    pattern, active, cache = compile_rules(rules) if isinstance(rules, list) else rules
+    if pattern is None:
+        return None
+    name = name or ""
+    try:
+        return cache[name]
+    except KeyError:
+        pass
+    best = min((m.lastindex for m in pattern.finditer(name.lower())), default=None)
+    rule = active[best - 1] if best else None
+    if len(cache) < MATCH_CACHE_SIZE:
+        cache[name] = rule
+    return rule
 
 
 def to_date_iso(br_date: Optional[str]) -> Optional[str]:
@@ -37,12 +93,11 @@ def to_date_iso(br_date: Optional[str]) -> Optional[str]:
     try:
         if "T" in br_date and len(br_date) >= 10:
             return br_date[:10]
+        if "/" in br_date:
+            return br_to_iso(br_date)
         if " " in br_date:
             parsed = datetime.strptime(br_date, "%Y-%m-%d %H:%M:%S")
             return parsed.strftime("%Y-%m-%d")
-        if "/" in br_date:
-            parsed = datetime.strptime(br_date, "%d/%m/%Y")
-            return parsed.strftime("%Y-%m-%d")
         if len(br_date) >= 10:
             return br_date[:10]
     except ValueError:
@@ -60,65 +115,100 @@ def competence_from_date(date_iso: Optional[str]) -> Optional[str]:
     return date_iso[:7]
 
 
-def flatten_proc(proc: Dict[str, Any], rules: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def flatten_proc(proc: Dict[str, Any], rules: Union[RuleMatcher, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    if isinstance(rules, list):
+        rules = compile_rules(rules)
     out: List[Dict[str, Any]] = []
     pid = str(proc.get("ProcID") or proc.get("ProcId") or "")
     emp = proc.get("EmpNome") or proc.get("Empresa")
     cnpj = proc.get("EmpCNPJ") or proc.get("CNPJ")
     regime = proc.get("ProcDepartamento") or proc.get("Departamento") or ""
     passos = proc.get("ProcPassos") or []
+    # Igual para todos os passos do processo: calcula uma vez só
+    data_evento = to_date_iso(proc.get("ProcConclusao") or proc.get("ProcInicio"))
+
+    # Pilha explícita em ordem reversa: pop() devolve os passos na mesma ordem
+    # (pré-ordem) da antiga recursão, sem um frame por nível de ProcPassos
+    stack: List[Dict[str, Any]] = list(reversed(passos))
+    while stack:
+        item = stack.pop()
+        nome = item.get("Nome") or item.get("Descricao") or ""
+        status_passo = item.get("Status")
+        autom = item.get("Automacao") or item.get("AutomacaoEntrega")
+        bloqueante = None
+        prazo = None
+        responsavel = None
+        nome_chk = nome
+
+        if isinstance(autom, dict):
+            bloqueante = autom.get("Bloqueante")
+            entrega = autom.get("Entrega")
+            if isinstance(entrega, dict):
+                prazo = entrega.get("Prazo") or entrega.get("EntregaPrazo")
+                responsavel = entrega.get("Responsavel")
+                nome_entrega = entrega.get("Nome") or ""
+                if nome_entrega:
+                    nome_chk = f"{nome} | {nome_entrega}"
+        rule = match_rule(nome_chk, rules)
+        if rule:
+            evt = {
+                "source": "api",
+                "categoria": "process_step",
+                "proc_id": pid,
+                "empresa": emp,
+                "cnpj": cnpj,
+                "regime": regime,
+                "subtipo": rule.get("subtipo"),
+                "status": rule.get("status"),
+                "responsavel": responsavel,
+                "prazo": to_date_iso(prazo),
+                "data_evento": data_evento,
+                "competencia": None,
+                "passo_status": status_passo,
+                "bloqueante": str(bloqueante).lower() == "sim",
+            }
+            if evt["prazo"]:
+                evt["competencia"] = competence_from_date(evt["prazo"])
+            elif evt["data_evento"]:
+                evt["competencia"] = competence_from_date(evt["data_evento"])
+            out.append(evt)
+
+        sub = item.get("ProcPassos")
+        if isinstance(sub, list) and sub:
+            stack.extend(reversed(sub))
 
-    def walk(items: Iterable[Dict[str, Any]]):
-        for item in items:
-            nome = item.get("Nome") or item.get("Descricao") or ""
-            status_passo = item.get("Status")
-            autom = item.get("Automacao") or item.get("AutomacaoEntrega")
-            bloqueante = None
-            prazo = None
-            responsavel = None
-            nome_chk = nome
-
-            if isinstance(autom, dict):
-                bloqueante = autom.get("Bloqueante")
-                entrega = autom.get("Entrega")
-                if isinstance(entrega, dict):
-                    prazo = entrega.get("Prazo") or entrega.get("EntregaPrazo")
-                    responsavel = entrega.get("Responsavel")
-                    nome_entrega = entrega.get("Nome") or ""
-                    if nome_entrega:
-                        nome_chk = f"{nome} | {nome_entrega}"
-            rule = match_rule(nome_chk, rules)
-            if rule:
-                evt = {
-                    "source": "api",
-                    "categoria": "process_step",
-                    "proc_id": pid,
-                    "empresa": emp,
-                    "cnpj": cnpj,
-                    "regime": regime,
-                    "subtipo": rule.get("subtipo"),
-                    "status": rule.get("status"),
-                    "responsavel": responsavel,
-                    "prazo": to_date_iso(prazo),
-                    "data_evento": to_date_iso(proc.get("ProcConclusao") or proc.get("ProcInicio")),
-                    "competencia": None,
-                    "passo_status": status_passo,
-                    "bloqueante": str(bloqueante).lower() == "sim",
-                }
-                if evt["prazo"]:
-                    evt["competencia"] = competence_from_date(evt["prazo"])
-                elif evt["data_evento"]:
-                    evt["competencia"] = competence_from_date(evt["data_evento"])
-                out.append(evt)
-
-            sub = item.get("ProcPassos")
-            if isinstance(sub, list) and sub:
-                walk(sub)
-
-    walk(passos)
     return out
 
 
+def _flatten_chunk(processes: List[Any], rules: RuleMatcher) -> List[Dict[str, Any]]:
+    out: List[Dict[str, Any]] = []
+    for proc in processes:
+        if isinstance(proc, dict):
+            out.extend(flatten_proc(proc, rules))
+    return out
+
+
+def flatten_all(processes: List[Any], rules: RuleMatcher) -> List[Dict[str, Any]]:
+    """
+    Achata todos os processos. Cada processo é independente, então listas grandes
+    são divididas em fatias contíguas e processadas em paralelo; ``map`` devolve
+    as fatias na ordem original, mantendo a ordem dos eventos.
+    """
+    workers = os.cpu_count() or 1
+    if workers < 2 or len(processes) < PARALLEL_MIN_PROCESSES:
+        return _flatten_chunk(processes, rules)
+    size = -(-len(processes) // workers)
+    chunks = [processes[i:i + size] for i in range(0, len(processes), size)]
+    all_events: List[Dict[str, Any]] = []
+    # "spawn": no scheduler esta etapa roda numa thread ao lado de outras, e um
+    # fork copiaria locks seguros por elas naquele instante
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        for events in executor.map(_flatten_chunk, chunks, [rules] * len(chunks)):
+            all_events.extend(events)
+    return all_events
+
+
 def delivery_events(deliveries: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
     events: List[Dict[str, Any]] = []
     for delivery in deliveries:
@@ -175,22 +265,18 @@ def delivery_events(deliveries: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]
 
 def main() -> None:
     processes = load_json(API_FILE)
-    deliveries = load_json(DELIVERIES_FILE)
-    rules = load_json(RULES_PATH).get("matchers", [])
+    rules = compile_rules(load_json(RULES_PATH).get("matchers", []))
 
     log("flatten_steps", "INFO", "Processando processos", count=len(processes))
-    all_events: List[Dict[str, Any]] = []
-    for proc in processes:
-        if isinstance(proc, dict):
-            all_events.extend(flatten_proc(proc, rules))
+    all_events = flatten_all(processes, rules)
 
     log("flatten_steps", "INFO", "Eventos de passos", total=len(all_events))
 
-    delivery_evts = delivery_events(deliveries)
+    delivery_evts = delivery_events(iter_deliveries(DELIVERIES_FILE))
     log("flatten_steps", "INFO", "Eventos de deliveries", total=len(delivery_evts))
     all_events.extend(delivery_evts)
 
-    EVENTS_API.write_text(json.dumps(all_events, ensure_ascii=False, indent=2), encoding="utf-8")
+    dump_json(EVENTS_API, all_events)
     log("flatten_steps", "INFO", "Salvo events_api.json", total=len(all_events))
 
 
@@ -1,13 +1,15 @@
 """Fuse API and email events into a consolidated dataset."""
 from __future__ import annotations
 
-import hashlib
 import hashlib
 import json
+import sys
 from pathlib import Path
-from typing import Any, Dict, Iterable, List
+from collections import Counter
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
 
 from scripts.utils.logger import log
+from scripts.utils.optional import ijson, orjson
 
 # Importar módulos do banco de dados
 try:
@@ -26,24 +28,75 @@ OUT_EVENTS = DATA / "events.json"
 OUT_DIVERG = DATA / "divergences.json"
 
 
-def load_events(path: Path) -> List[Dict[str, Any]]:
+def load_events(path: Path) -> Iterator[Dict[str, Any]]:
+    """Itera os eventos de um JSON (lista) sem materializá-lo quando ijson está disponível."""
     if not path.exists():
-        return []
-    return json.loads(path.read_text(encoding="utf-8"))
-
-
-def make_key(event: Dict[str, Any]) -> str:
-    pieces = [
-        event.get("source") or "",
-        event.get("empresa") or "",
-        event.get("subtipo") or "",
-        event.get("status") or "",
-        event.get("competencia") or "",
-        event.get("prazo") or "",
-        event.get("entrega") or "",
-    ]
-    joined = "||".join(str(piece) for piece in pieces)
-    return hashlib.sha1(joined.encode("utf-8")).hexdigest()
+        return
+    if ijson is None:
+        if orjson is not None:
+            yield from orjson.loads(path.read_bytes())
+        else:
+            yield from json.loads(path.read_text(encoding="utf-8"))
+        return
+    with path.open("rb") as fp:
+        yield from ijson.items(fp, "item", use_float=True)
+
+
+def _tally(events: Iterable[Dict[str, Any]], counts: Counter, name: str) -> Iterator[Dict[str, Any]]:
+    for event in events:
+        counts[name] += 1
+        yield event
+
+
+# Campos de baixa cardinalidade: repetem os mesmos valores em milhares de eventos
+_SHARED_FIELDS = (
+    "source", "empresa", "cnpj", "regime", "categoria", "subtipo", "status",
+    "responsavel", "competencia", "prazo", "entrega", "data_evento", "passo_status",
+)
+
+
+def _share_values(events: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    Interna as strings repetidas dos eventos: cada valor distinto passa a existir
+    uma vez só na memória, compartilhado entre os dicts e as chaves do merge.
+    """
+    intern = sys.intern
+    for event in events:
+        for field in _SHARED_FIELDS:
+            value = event.get(field)
+            if type(value) is str:
+                event[field] = intern(value)
+        yield event
+
+
+def _dump_json(path: Path, payload: Any) -> None:
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(payload, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        return
+    # json.dump codifica em pedaços direto no arquivo, sem montar a string inteira
+    with path.open("w", encoding="utf-8") as fp:
+        json.dump(payload, fp, ensure_ascii=False, indent=2)
+
+
+EventKey = Tuple[str, ...]
+
+
+def make_key(event: Dict[str, Any]) -> EventKey:
+    """Chave em memória do merge: tupla hasheável, sem encode/SHA-1 por evento."""
+    return (
+        str(event.get("source") or ""),
+        str(event.get("empresa") or ""),
+        str(event.get("subtipo") or ""),
+        str(event.get("status") or ""),
+        str(event.get("competencia") or ""),
+        str(event.get("prazo") or ""),
+        str(event.get("entrega") or ""),
+    )
+
+
+def persisted_key(key: EventKey) -> str:
+    """SHA-1 estável da chave, calculado só para o que vai para disco (divergências)."""
+    return hashlib.sha1("||".join(key).encode("utf-8")).hexdigest()
 
 
 def prefer_email(event: Dict[str, Any]) -> bool:
@@ -55,7 +108,7 @@ def prefer_email(event: Dict[str, Any]) -> bool:
 
 
 def fuse(api_events: Iterable[Dict[str, Any]], email_events: Iterable[Dict[str, Any]]):
-    merged: Dict[str, Dict[str, Any]] = {}
+    merged: Dict[EventKey, Dict[str, Any]] = {}
     divergences: List[Dict[str, Any]] = []
 
     for event in api_events:
@@ -63,16 +116,16 @@ def fuse(api_events: Iterable[Dict[str, Any]], email_events: Iterable[Dict[str,
 
     for event in email_events:
         key = make_key(event)
-        existing = merged.get(key)
-        if not existing:
-            merged[key] = event
+        # setdefault insere o e-mail sem evento da API na mesma busca de hash
+        existing = merged.setdefault(key, event)
+        if existing is event:
             continue
         if existing.get("categoria") == "obrigacao" and event.get("categoria") == "obrigacao":
             # keep API version
             continue
         if prefer_email(event):
             divergences.append({
-                "key": key,
+                "key": persisted_key(key),
                 "api": existing,
                 "email": event,
             })
@@ -123,6 +176,7 @@ def load_events_from_db() -> List[Dict[str, Any]]:
 
 def main() -> None:
     # Tentar carregar do banco primeiro, depois fallback para JSON
+    api_events: Iterable[Dict[str, Any]]
     if DB_AVAILABLE:
         api_events = load_events_from_db()
         if not api_events:
@@ -130,12 +184,15 @@ def main() -> None:
     else:
         api_events = load_events(EVT_API)
     
-    email_events = load_events(EVT_MAIL)
-    log("fuse_sources", "INFO", "Eventos carregados", api=len(api_events), email=len(email_events))
-
-    merged, divergences = fuse(api_events, email_events)
-    OUT_EVENTS.write_text(json.dumps(merged, ensure_ascii=False, indent=2), encoding="utf-8")
-    OUT_DIVERG.write_text(json.dumps(divergences, ensure_ascii=False, indent=2), encoding="utf-8")
+    counts: Counter = Counter()
+    merged, divergences = fuse(
+        _tally(_share_values(api_events), counts, "api"),
+        _tally(_share_values(load_events(EVT_MAIL)), counts, "email"),
+    )
+    log("fuse_sources", "INFO", "Eventos carregados", api=counts["api"], email=counts["email"])
+
+    _dump_json(OUT_EVENTS, merged)
+    _dump_json(OUT_DIVERG, divergences)
 
     log("fuse_sources", "INFO", "Fusionados", total=len(merged), divergencias=len(divergences))
 
@@ -1,17 +1,24 @@
 """Utilities to orchestrate the Gestor data pipeline."""
 from __future__ import annotations
 
+import hashlib
 import json
-import re
+import os
 import threading
 import time
 from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
+from queue import SimpleQueue
 from statistics import mean, median
-from typing import Any, Dict, Iterable, List, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import case, func
+from sqlalchemy.orm import joinedload, selectinload
 
 from scripts.acessorias_client import AcessoriasClient
 from scripts.db import (
@@ -19,6 +26,9 @@ from scripts.db import (
     Delivery,
     Event,
     Process,
+    bulk_upsert_companies,
+    bulk_upsert_deliveries,
+    bulk_upsert_processes,
     clear_events,
     ensure_database,
     get_session,
@@ -26,12 +36,11 @@ from scripts.db import (
     parse_datetime,
     reset_sync_state,
     save_sync_state,
-    upsert_company,
-    upsert_delivery,
     upsert_event,
-    upsert_process,
 )
+from scripts.utils.locks import PIPELINE_LOCK
 from scripts.utils.logger import get_logger, log
+from scripts.utils.optional import ahocorasick, np, orjson, xxhash
 
 ROOT = Path(__file__).resolve().parents[1]
 DATA_DIR = ROOT / "data"
@@ -43,6 +52,7 @@ FILES = {
     "deliveries": DATA_DIR / "deliveries.json",
     "deliveries_raw": DATA_DIR / "deliveries_raw.json",
     "companies": DATA_DIR / "companies.json",
+    "companies_raw": DATA_DIR / "companies_raw.json",
     "events": DATA_DIR / "events.json",
     "alerts": DATA_DIR / "alerts.json",
     "kpis": DATA_DIR / "kpis.json",
@@ -56,7 +66,12 @@ FILES = {
 RULES_PATH = ROOT / "scripts" / "rules.json"
 
 PIPELINE_LOG = get_logger("pipeline")
-PIPELINE_LOCK = threading.Lock()
+# Tamanho dos lotes lidos do cursor nas consultas percorridas uma vez só
+STREAM_BATCH = 1000
+# Threads de gravação dos artefatos do compute_kpis
+JSON_WRITE_WORKERS = 4
+# Workers da carga completa de deliveries (uma busca por CNPJ em paralelo)
+FULL_SYNC_WORKERS = 4
 
 COUNTER_ALIASES = {
     "entregues": ["Entregues", "entregues", "total_entregues"],
@@ -64,6 +79,9 @@ COUNTER_ALIASES = {
     "proximos30": ["Proximos30D", "Proximos30d", "Proximos30", "proximos30", "prox_30"],
     "futuras30": ["Futuras30+", "Futuras30", "futuras30", "fut_30"],
 }
+# Aliases + a própria chave, montados uma vez para o laço de merge
+COUNTER_ALIAS_TUPLES = {key: tuple(aliases) + (key,) for key, aliases in COUNTER_ALIASES.items()}
+_MISSING = object()
 
 
 def ensure_environment() -> None:
@@ -72,9 +90,67 @@ def ensure_environment() -> None:
     ensure_database()
 
 
-def _write_json(path: Path, payload: Any) -> None:
+def _json_encoder(human: bool) -> json.JSONEncoder:
+    if human:
+        return json.JSONEncoder(ensure_ascii=False, indent=2)
+    return json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def _artifact_unchanged(path: Path, hash_path: Path, digest: bytes) -> bool:
+    """
+    O sidecar guarda hash, tamanho e mtime do arquivo como gravado aqui. Se outro
+    processo (ex.: fetch_deliveries) regravou o arquivo, o stat não confere e ele
+    é regravado mesmo com o mesmo conteúdo.
+    """
+    try:
+        stored = hash_path.read_text(encoding="ascii").split()
+        stat = path.stat()
+    except (OSError, ValueError):
+        return False
+    return stored == [digest.hex(), str(stat.st_size), str(stat.st_mtime_ns)]
+
+
+def _write_json(path: Path, payload: Any, human: bool = False) -> None:
+    """
+    Grava ``payload`` em ``path``. Os dumps volumosos (api_processes,
+    deliveries_raw, events) saem compactos; ``human=True`` indenta os arquivos
+    pensados para leitura (KPIs, alertas, séries). Se o conteúdo e o arquivo em
+    disco são os mesmos da última gravação (sidecar ``.hash``), nada é reescrito;
+    senão grava num tmp e troca com os.replace (nunca fica um arquivo truncado).
+    """
     path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    hash_path = path.with_name(path.name + ".hash")
+    tmp = path.with_name(path.name + ".tmp")
+    hasher = xxhash.xxh3_64() if xxhash is not None else hashlib.blake2b(digest_size=8)
+
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if human else 0)
+        blob = orjson.dumps(payload, option=option)
+        hasher.update(blob)
+        digest = hasher.digest()
+        if _artifact_unchanged(path, hash_path, digest):
+            return
+        tmp.write_bytes(blob)
+    else:
+        # Sem orjson: uma passada só calcula o hash; o arquivo é gravado em
+        # pedaços (sem montar a string inteira) apenas quando algo mudou
+        encoder = _json_encoder(human)
+        for chunk in encoder.iterencode(payload):
+            hasher.update(chunk.encode("utf-8"))
+        digest = hasher.digest()
+        if _artifact_unchanged(path, hash_path, digest):
+            return
+        with tmp.open("w", encoding="utf-8") as fp:
+            for chunk in encoder.iterencode(payload):
+                fp.write(chunk)
+    os.replace(tmp, path)
+    stat = path.stat()
+    hash_path.write_text(f"{digest.hex()} {stat.st_size} {stat.st_mtime_ns}", encoding="ascii")
+
+
+# Tabela para str.translate: mantém só dígitos, vírgula, ponto e sinal; o
+# defaultdict devolve None (remove) para qualquer outro caractere
+_NUMERIC_TABLE: Dict[int, Optional[str]] = defaultdict(lambda: None, {ord(c): c for c in "0123456789,.-"})
 
 
 def _safe_int(value: Any) -> int:
@@ -88,7 +164,9 @@ def _safe_int(value: Any) -> int:
     text = str(value).strip()
     if not text:
         return 0
-    cleaned = re.sub(r"[^0-9,.-]", "", text)
+    if text.isascii() and text.isdigit():
+        return int(text)
+    cleaned = text.translate(_NUMERIC_TABLE)
     if not cleaned:
         return 0
     try:
@@ -99,10 +177,11 @@ def _safe_int(value: Any) -> int:
 
 def _merge_counter_values(target: Dict[str, int], source: Dict[str, Any]) -> bool:
     changed = False
-    for key, aliases in COUNTER_ALIASES.items():
-        for alias in aliases + [key]:
-            if alias in source:
-                value = _safe_int(source.get(alias))
+    for key, aliases in COUNTER_ALIAS_TUPLES.items():
+        for alias in aliases:
+            raw = source.get(alias, _MISSING)
+            if raw is not _MISSING:
+                value = _safe_int(raw)
                 if value:
                     target[key] += value
                     changed = True
@@ -138,15 +217,19 @@ def _counters_from_payload(payload: Optional[Dict[str, Any]]) -> Optional[Dict[s
     return totals if has_data else None
 
 
-def _counters_from_deliveries(deliveries: Iterable[Delivery]) -> Optional[Dict[str, int]]:
+def _counters_from_deliveries(
+    deliveries: Iterable[Delivery],
+    today: Optional[date] = None,
+) -> Optional[Dict[str, int]]:
     totals = {key: 0 for key in COUNTER_ALIASES}
     has_data = False
-    today = datetime.now(timezone.utc).date()
+    today = today or datetime.now(timezone.utc).date()
 
     for delivery in deliveries or []:
         dt_entrega = delivery.dt_entrega.date() if delivery.dt_entrega else None
         dt_prazo = delivery.dt_prazo.date() if delivery.dt_prazo else None
         situacao = (delivery.situacao or "").lower()
+        atrasada = "atras" in situacao
 
         if dt_entrega or "entreg" in situacao:
             totals["entregues"] += 1
@@ -156,7 +239,7 @@ def _counters_from_deliveries(deliveries: Iterable[Delivery]) -> Optional[Dict[s
         if dt_prazo:
             diff = (dt_prazo - today).days
             has_data = True
-            if diff < 0 or "atras" in situacao:
+            if diff < 0 or atrasada:
                 totals["atrasadas"] += 1
             elif diff <= 30:
                 totals["proximos30"] += 1
@@ -164,7 +247,7 @@ def _counters_from_deliveries(deliveries: Iterable[Delivery]) -> Optional[Dict[s
                 totals["futuras30"] += 1
             continue
 
-        if "atras" in situacao:
+        if atrasada:
             totals["atrasadas"] += 1
             has_data = True
 
@@ -178,18 +261,46 @@ def payload_counters(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     return {"totals": totals, "source": "payload"}
 
 
-def company_counters(company: Company) -> Optional[Dict[str, Any]]:
-    totals = _counters_from_payload(company.dados or {})
-    if totals:
-        return {"totals": totals, "source": "payload"}
-
-    deliveries_totals = _counters_from_deliveries(company.deliveries or [])
+def company_counters(company: Company, today: Optional[date] = None) -> Optional[Dict[str, Any]]:
+    # A tabela companies não guarda o payload da API: os contadores da empresa
+    # saem das deliveries
+    deliveries_totals = _counters_from_deliveries(company.deliveries or [], today)
     if deliveries_totals:
         return {"totals": deliveries_totals, "source": "deliveries"}
 
     return None
 
 
+def _fetch_after(fetch_page: Callable[[int], List[Dict[str, Any]]], page: int, delay: float) -> List[Dict[str, Any]]:
+    # Respeita o rate limit antes de cada página seguinte
+    time.sleep(delay)
+    return fetch_page(page)
+
+
+def _iter_pages(
+    fetch_page: Callable[[int], List[Dict[str, Any]]],
+    page_size: int,
+    delay: float,
+) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+    """
+    Itera as páginas (número, lote) até vir uma vazia ou incompleta. A página
+    seguinte é buscada em background enquanto o chamador grava a atual no banco;
+    ela só é pedida quando a atual veio cheia, então nunca há busca a cancelar.
+    """
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        page = 1
+        pending = pool.submit(fetch_page, page)
+        while pending is not None:
+            batch = pending.result()
+            if not batch:
+                return
+            pending = None
+            if len(batch) >= page_size:
+                pending = pool.submit(_fetch_after, fetch_page, page + 1, delay)
+            yield page, batch
+            page += 1
+
+
 def collect_processes(
     *,
     statuses: Optional[List[str]] = None,
@@ -226,23 +337,22 @@ def collect_processes(
 
         status_list = statuses or [None]
         for status in status_list:
-            page = 1
-            while True:
-                batch = client.list_processes(
+            def fetch_page(page: int, status=status) -> List[Dict[str, Any]]:
+                return client.list_processes(
                     status=status,
                     page=page,
                     per_page=page_size,
                     dt_last_dh=dt_last,
                     filters=filters,
                 )
-                if not batch:
-                    break
 
+            for page, batch in _iter_pages(fetch_page, page_size, client.sleep_seconds):
+                # Um INSERT ... ON CONFLICT por página em vez de um upsert por linha
+                bulk_upsert_processes(session, batch)
                 for row in batch:
-                    upsert_process(session, row)
                     fetched.append(row)
                     if row.get("DtLastDH"):
-                        candidate = parse_datetime(row.get("DtLastDH"))
+                        candidate = _parse_dt(row.get("DtLastDH"))
                         if candidate and (
                             not max_last_dh or candidate > max_last_dh
                         ):
@@ -257,12 +367,6 @@ def collect_processes(
                     count=len(batch),
                 )
 
-                if len(batch) < page_size:
-                    break
-
-                page += 1
-                time.sleep(client.sleep_seconds)
-
         if not max_last_dh:
             max_last_dh = datetime.now(timezone.utc)
 
@@ -287,11 +391,10 @@ def _deliveries_incremental(
     dt_last = state.last_sync_dh if state and state.last_sync_dh else today
 
     fetched: List[Dict[str, Any]] = []
-    page = 1
     max_last = state.last_sync_dh if state else None
 
-    while True:
-        batch = client.list_deliveries(
+    def fetch_page(page: int) -> List[Dict[str, Any]]:
+        return client.list_deliveries(
             identificador="ListAll",
             page=page,
             per_page=page_size,
@@ -299,28 +402,72 @@ def _deliveries_incremental(
             dt_initial=dt_initial,
             dt_final=dt_final,
         )
-        if not batch:
-            break
 
+    for page, batch in _iter_pages(fetch_page, page_size, client.sleep_seconds):
+        bulk_upsert_deliveries(session, batch)
         for row in batch:
-            upsert_delivery(session, row)
             fetched.append(row)
             if row.get("DtLastDH"):
-                candidate = parse_datetime(row.get("DtLastDH"))
+                candidate = _parse_dt(row.get("DtLastDH"))
                 if candidate and (not max_last or candidate > max_last):
                     max_last = candidate
             elif row.get("EntDtEvento"):
-                candidate = parse_datetime(row.get("EntDtEvento"))
+                candidate = _parse_dt(row.get("EntDtEvento"))
                 if candidate and (not max_last or candidate > max_last):
                     max_last = candidate
         session.commit()
         log("pipeline", "INFO", "deliveries_page", mode="incremental", page=page, count=len(batch))
+
+    return fetched, max_last
+
+
+def _throttle(interval: float) -> Callable[[], None]:
+    """
+    Devolve uma função que bloqueia até o próximo horário livre. Compartilhada
+    entre threads, mantém as chamadas espaçadas em ``interval`` segundos no total,
+    respeitando o rate budget da API mesmo com vários workers.
+    """
+    lock = threading.Lock()
+    next_slot = [0.0]
+
+    def wait() -> None:
+        with lock:
+            now = time.monotonic()
+            slot = max(now, next_slot[0])
+            next_slot[0] = slot + interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    return wait
+
+
+def _fetch_company_deliveries(
+    client: AcessoriasClient,
+    throttle: Callable[[], None],
+    cnpj: str,
+    *,
+    dt_initial: str,
+    dt_final: str,
+    page_size: int,
+) -> List[Tuple[int, List[Dict[str, Any]]]]:
+    pages: List[Tuple[int, List[Dict[str, Any]]]] = []
+    page = 1
+    while True:
+        throttle()
+        batch = client.deliveries_by_cnpj(
+            cnpj=cnpj,
+            page=page,
+            per_page=page_size,
+            dt_initial=dt_initial,
+            dt_final=dt_final,
+        )
+        if not batch:
+            break
+        pages.append((page, batch))
         if len(batch) < page_size:
             break
         page += 1
-        time.sleep(client.sleep_seconds)
-
-    return fetched, max_last
+    return pages
 
 
 def _deliveries_full(
@@ -336,30 +483,35 @@ def _deliveries_full(
 
     companies = session.query(Company).all()
     fetched: List[Dict[str, Any]] = []
-
-    for company in companies:
-        page = 1
-        while True:
-            batch = client.deliveries_by_cnpj(
-                cnpj=company.cnpj,
-                page=page,
-                per_page=page_size,
-                dt_initial=dt_initial,
-                dt_final=dt_final,
+    throttle = _throttle(client.sleep_seconds)
+
+    # As buscas por CNPJ são independentes: vão em paralelo (com o espaçamento
+    # global do throttle) e a gravação fica na thread principal, na ordem das empresas
+    with ThreadPoolExecutor(max_workers=FULL_SYNC_WORKERS) as pool:
+        futures = [
+            (
+                company.cnpj,
+                pool.submit(
+                    _fetch_company_deliveries,
+                    client,
+                    throttle,
+                    company.cnpj,
+                    dt_initial=dt_initial,
+                    dt_final=dt_final,
+                    page_size=page_size,
+                ),
             )
-            if not batch:
-                break
-            for row in batch:
-                if not row.get("CNPJ"):
-                    row["CNPJ"] = company.cnpj
-                upsert_delivery(session, row)
-                fetched.append(row)
-            session.commit()
-            log("pipeline", "INFO", "deliveries_page", mode="full", cnpj=company.cnpj, page=page, count=len(batch))
-            if len(batch) < page_size:
-                break
-            page += 1
-            time.sleep(client.sleep_seconds)
+            for company in companies
+        ]
+        for cnpj, future in futures:
+            for page, batch in future.result():
+                for row in batch:
+                    if not row.get("CNPJ"):
+                        row["CNPJ"] = cnpj
+                    fetched.append(row)
+                bulk_upsert_deliveries(session, batch)
+                session.commit()
+                log("pipeline", "INFO", "deliveries_page", mode="full", cnpj=cnpj, page=page, count=len(batch))
 
     return fetched
 
@@ -442,8 +594,8 @@ def collect_companies(*, page_size: int = 100) -> List[Dict[str, Any]]:
                     counters = payload_counters(row)
                     if counters:
                         row["counters"] = counters
-                upsert_company(session, row)
                 fetched.append(dict(row) if isinstance(row, dict) else row)
+            bulk_upsert_companies(session, [row for row in batch if isinstance(row, dict)])
             session.commit()
             log("pipeline", "INFO", "companies_page", page=page, count=len(batch))
             if len(batch) < page_size:
@@ -451,33 +603,94 @@ def collect_companies(*, page_size: int = 100) -> List[Dict[str, Any]]:
             page += 1
             time.sleep(client.sleep_seconds)
 
-        _write_json(FILES["companies"], fetched)
+        # companies.json (com contadores) é do compute_kpis; aqui fica só o bruto da API
+        _write_json(FILES["companies_raw"], fetched)
         return fetched
     finally:
         session.close()
 
 
-def _load_rules() -> List[Dict[str, Any]]:
-    if not RULES_PATH.exists():
-        return []
+# (contains já em minúsculas, regra): o lower() das regras é feito uma vez só
+LoweredRule = Tuple[str, Dict[str, Any]]
+# Regras em minúsculas + autômato Aho-Corasick (None sem pyahocorasick ou sem regras)
+RuleSet = Tuple[List[LoweredRule], Optional[Any]]
+
+
+@lru_cache(maxsize=1)
+def _load_rules_cached(mtime_ns: int) -> RuleSet:
+    # mtime_ns entra só na chave do cache: mudou o rules.json, relê
     try:
-        data = json.loads(RULES_PATH.read_text(encoding="utf-8"))
-        if isinstance(data, dict):
-            return data.get("matchers", []) or []
-        return []
+        if orjson is not None:
+            data = orjson.loads(RULES_PATH.read_bytes())
+        else:
+            data = json.loads(RULES_PATH.read_text(encoding="utf-8"))
+        if not isinstance(data, dict):
+            return [], None
+        matchers = data.get("matchers", []) or []
     except Exception:
-        return []
+        return [], None
+    lowered: List[LoweredRule] = []
+    for rule in matchers:
+        needle = (rule.get("contains") or "").lower()
+        if needle:
+            lowered.append((needle, rule))
+    return lowered, _build_automaton(lowered)
+
+
+def _build_automaton(lowered: List[LoweredRule]) -> Optional[Any]:
+    if ahocorasick is None or not lowered:
+        return None
+    automaton = ahocorasick.Automaton()
+    for index, (needle, rule) in enumerate(lowered):
+        # Trecho repetido: vale a primeira regra, como no laço linear
+        if not automaton.exists(needle):
+            automaton.add_word(needle, (index, rule))
+    automaton.make_automaton()
+    return automaton
 
 
-def _match_rule(name: str, rules: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+def _load_rules() -> RuleSet:
+    """Regras já em minúsculas, reaproveitadas enquanto o arquivo não mudar (não mutar o retorno)."""
+    try:
+        mtime_ns = RULES_PATH.stat().st_mtime_ns
+    except OSError:
+        return [], None
+    return _load_rules_cached(mtime_ns)
+
+
+def _match_rule(name: str, rules: RuleSet) -> Optional[Dict[str, Any]]:
+    lowered, automaton = rules
     low = (name or "").lower()
-    for rule in rules:
-        needle = (rule.get("contains") or "").lower()
-        if needle and needle in low:
+    if automaton is not None:
+        # O autômato devolve as ocorrências por posição; vence a de menor
+        # índice no rules.json, igual ao laço linear
+        best = min((found for _, found in automaton.iter(low)), default=None, key=lambda found: found[0])
+        return best[1] if best else None
+    for needle, rule in lowered:
+        if needle in low:
             return rule
     return None
 
 
+# Os mesmos textos de data (ProcInicio, EntDtPrazo da competência...) se repetem
+# em milhares de linhas; strptime é caro, então os resultados ficam em cache
+DATE_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_datetime_cached(value: Any) -> Optional[datetime]:
+    return parse_datetime(value)
+
+
+def _parse_dt(value: Any) -> Optional[datetime]:
+    try:
+        return _parse_datetime_cached(value)
+    except TypeError:
+        # valor não hasheável: sem cache
+        return parse_datetime(value)
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
 def _to_date_iso(value: Optional[str]) -> Optional[str]:
     if not value:
         return None
@@ -501,7 +714,7 @@ def _competence_from_date(value: Optional[str]) -> Optional[str]:
     return value[:7]
 
 
-def _flatten_process_events(proc: Process, rules: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def _flatten_process_events(proc: Process, rules: RuleSet) -> List[Dict[str, Any]]:
     raw = proc.raw or {}
     passos = raw.get("ProcPassos") or []
     empresa = raw.get("EmpNome") or (proc.company.nome if proc.company else None)
@@ -510,45 +723,54 @@ def _flatten_process_events(proc: Process, rules: List[Dict[str, Any]]) -> List[
     proc_id = raw.get("ProcID") or proc.id_acessorias
 
     events: List[Dict[str, Any]] = []
+    if not isinstance(passos, list):
+        return events
+    # Igual para todos os passos do processo: calcula uma vez só
+    data_evento = _to_date_iso(raw.get("ProcConclusao") or raw.get("ProcInicio"))
+
+    # Pilha explícita de (passo, nome do pai) em ordem reversa: pop() devolve os
+    # passos na mesma pré-ordem da antiga recursão, sem um frame por nível
+    stack: List[Tuple[Dict[str, Any], str]] = [(item, "") for item in reversed(passos)]
+    while stack:
+        item, parent = stack.pop()
+        nome = item.get("Nome") or item.get("Descricao") or parent
+        autom = item.get("Automacao") or item.get("AutomacaoEntrega") or {}
+        entrega = autom.get("Entrega") or {}
+        prazo = entrega.get("Prazo") or entrega.get("EntregaPrazo")
+        responsavel = entrega.get("Responsavel") or autom.get("Responsavel")
+        nome_entrega = entrega.get("Nome") or ""
+        label = nome_entrega and f"{nome} | {nome_entrega}" or nome
+        rule = _match_rule(label, rules)
+        if rule:
+            prazo_iso = _to_date_iso(prazo)
+            events.append(
+                {
+                    "source": "process",
+                    "proc_id": proc_id,
+                    "empresa": empresa,
+                    "cnpj": cnpj,
+                    "categoria": rule.get("categoria"),
+                    "subtipo": rule.get("subtipo"),
+                    "status": rule.get("status"),
+                    "responsavel": responsavel,
+                    "regime": regime,
+                    "competencia": _competence_from_date(prazo_iso) or _competence_from_date(data_evento),
+                    "data_evento": data_evento,
+                    "prazo": prazo_iso,
+                }
+            )
+        sub = item.get("ProcPassos") or []
+        if isinstance(sub, list) and sub:
+            stack.extend((child, nome) for child in reversed(sub))
 
-    def walk(items: Iterable[Dict[str, Any]], parent: str = ""):
-        for item in items:
-            nome = item.get("Nome") or item.get("Descricao") or parent
-            autom = item.get("Automacao") or item.get("AutomacaoEntrega") or {}
-            entrega = autom.get("Entrega") or {}
-            prazo = entrega.get("Prazo") or entrega.get("EntregaPrazo")
-            responsavel = entrega.get("Responsavel") or autom.get("Responsavel")
-            nome_entrega = entrega.get("Nome") or ""
-            label = nome_entrega and f"{nome} | {nome_entrega}" or nome
-            rule = _match_rule(label, rules)
-            if rule:
-                prazo_iso = _to_date_iso(prazo)
-                data_evento = _to_date_iso(raw.get("ProcConclusao") or raw.get("ProcInicio"))
-                events.append(
-                    {
-                        "source": "process",
-                        "proc_id": proc_id,
-                        "empresa": empresa,
-                        "cnpj": cnpj,
-                        "categoria": rule.get("categoria"),
-                        "subtipo": rule.get("subtipo"),
-                        "status": rule.get("status"),
-                        "responsavel": responsavel,
-                        "regime": regime,
-                        "competencia": _competence_from_date(prazo_iso) or _competence_from_date(data_evento),
-                        "data_evento": data_evento,
-                        "prazo": prazo_iso,
-                    }
-                )
-            sub = item.get("ProcPassos") or []
-            if isinstance(sub, list) and sub:
-                walk(sub, nome)
-
-    if isinstance(passos, list):
-        walk(passos)
     return events
 
 
+# (trecho, rótulo) na ordem de prioridade dos antigos if/elif
+_DELIVERY_STATUS_MAP = (("disp", "Dispensada"), ("atras", "Atrasada"), ("obrig", "Obrigatória"))
+_CATEGORY_MAP = (("reinf", "efd_reinf"), ("contrib", "efd_contrib"), ("difal", "difal"))
+
+
 def _delivery_to_event(delivery: Delivery) -> Dict[str, Any]:
     payload = delivery.payload or {}
     empresa = delivery.company.nome if delivery.company else payload.get("Empresa")
@@ -571,24 +793,16 @@ def _delivery_to_event(delivery: Delivery) -> Dict[str, Any]:
 
     if entrega:
         status = "Entregue"
-    elif "disp" in status_text:
-        status = "Dispensada"
-    elif "atras" in status_text or atraso:
-        status = "Atrasada"
-    elif "obrig" in status_text:
-        status = "Obrigatória"
-    else:
-        status = status_text.title() if status_text else "Pendente"
-
-    categoria = (delivery.tipo or "").lower()
-    if "reinf" in categoria:
-        categoria = "efd_reinf"
-    elif "contrib" in categoria:
-        categoria = "efd_contrib"
-    elif "difal" in categoria:
-        categoria = "difal"
     else:
-        categoria = categoria or "outros"
+        status = next((label for needle, label in _DELIVERY_STATUS_MAP if needle in status_text), None)
+        # EntDtAtraso preenchido só perde para "dispensada"
+        if atraso and status != "Dispensada":
+            status = "Atrasada"
+        elif status is None:
+            status = status_text.title() if status_text else "Pendente"
+
+    categoria_low = (delivery.tipo or "").lower()
+    categoria = next((label for needle, label in _CATEGORY_MAP if needle in categoria_low), categoria_low or "outros")
 
     return {
         "source": "delivery",
@@ -625,11 +839,12 @@ def build_events() -> List[Dict[str, Any]]:
         rules = _load_rules()
         serialized: List[Dict[str, Any]] = []
 
-        processes = session.query(Process).all()
+        # yield_per: as linhas chegam em lotes do cursor em vez de todas de uma vez
+        processes = session.query(Process).options(selectinload(Process.company)).yield_per(STREAM_BATCH)
         for proc in processes:
             events = _flatten_process_events(proc, rules)
             for evt in events:
-                dt = parse_datetime(evt.get("data_evento") or evt.get("prazo"))
+                dt = _parse_dt(evt.get("data_evento") or evt.get("prazo"))
                 upsert_event(
                     session,
                     process=proc,
@@ -644,10 +859,10 @@ def build_events() -> List[Dict[str, Any]]:
                 serialized.append(evt)
         session.commit()
 
-        deliveries = session.query(Delivery).all()
+        deliveries = session.query(Delivery).options(joinedload(Delivery.company)).yield_per(STREAM_BATCH)
         for delivery in deliveries:
             evt = _delivery_to_event(delivery)
-            dt = parse_datetime(evt.get("data_evento") or evt.get("prazo"))
+            dt = _parse_dt(evt.get("data_evento") or evt.get("prazo"))
             upsert_event(
                 session,
                 process=None,
@@ -667,7 +882,7 @@ def build_events() -> List[Dict[str, Any]]:
         session.close()
 
 
-def _serialize_process(proc: Process) -> Dict[str, Any]:
+def _serialize_process(proc: Process, now: Optional[datetime] = None) -> Dict[str, Any]:
     def _iso(dt: Optional[datetime]) -> Optional[str]:
         return dt.isoformat() if dt else None
 
@@ -678,7 +893,7 @@ def _serialize_process(proc: Process) -> Dict[str, Any]:
     if inicio and conclusao:
         dias_corridos = max((conclusao - inicio).days, 0)
     elif inicio:
-        dias_corridos = max((datetime.now(timezone.utc) - inicio).days, 0)
+        dias_corridos = max(((now or datetime.now(timezone.utc)) - inicio).days, 0)
     else:
         dias_corridos = None
 
@@ -719,78 +934,84 @@ def _serialize_delivery(delivery: Delivery) -> Dict[str, Any]:
     }
 
 
-def _serialize_company(company: Company) -> Dict[str, Any]:
+def _serialize_company(company: Company, today: Optional[date] = None) -> Dict[str, Any]:
     return {
         "id": company.id,
-        "id_acessorias": company.id_acessorias,
         "cnpj": company.cnpj,
         "nome": company.nome,
-        "nome_fantasia": company.nome_fantasia,
-        "email": company.email,
-        "telefone": company.telefone,
-        "cidade": company.cidade,
-        "uf": company.uf,
-        "counters": company_counters(company),
-        "raw": company.dados,
+        "counters": company_counters(company, today),
     }
 
 
-def compute_kpis() -> Dict[str, Any]:
-    ensure_environment()
-    session = get_session()
-    try:
-        processes = session.query(Process).all()
-        deliveries = session.query(Delivery).all()
-        companies = session.query(Company).all()
-
-        serialized_processes = [_serialize_process(proc) for proc in processes]
-        serialized_deliveries = [_serialize_delivery(delivery) for delivery in deliveries]
-        serialized_companies = [_serialize_company(company) for company in companies]
-
-        _write_json(FILES["processes"], serialized_processes)
-        _write_json(FILES["deliveries"], serialized_deliveries)
-        _write_json(FILES["companies"], serialized_companies)
-
-        process_status = Counter(proc.status or "Sem status" for proc in processes)
-        deliveries_status = Counter(delivery.situacao or "Sem status" for delivery in deliveries)
-        deliveries_tipo = Counter(delivery.tipo or "Sem tipo" for delivery in deliveries)
-
-        concluido_hoje = sum(
-            1
-            for proc in processes
-            if proc.dt_conclusao and proc.dt_conclusao.date() == datetime.now(timezone.utc).date()
-        )
+def _fechamento_stats(dias: Iterable[int]) -> Dict[str, Any]:
+    """Média/mediana do dia de conclusão; numpy quando disponível, senão statistics."""
+    if np is not None:
+        arr = np.fromiter(dias, dtype=np.int16)
+        if not arr.size:
+            return {"media": None, "mediana": None, "n": 0}
+        med = np.median(arr)
+        return {
+            "media": round(float(arr.mean()), 2),
+            # mesmo tipo do statistics.median: int com n ímpar, float com n par
+            "mediana": int(med) if arr.size % 2 else float(med),
+            "n": int(arr.size),
+        }
+    values = list(dias)
+    return {
+        "media": round(mean(values), 2) if values else None,
+        "mediana": median(values) if values else None,
+        "n": len(values),
+    }
 
-        concluidos_mes = sum(
-            1
-            for proc in processes
-            if proc.dt_conclusao
-            and proc.dt_conclusao.year == datetime.now(timezone.utc).year
-            and proc.dt_conclusao.month == datetime.now(timezone.utc).month
-        )
 
-        dias_fechamento = [proc.dt_conclusao.day for proc in processes if proc.dt_conclusao]
+def _tally(rows: Iterable[Tuple[Optional[str], int]], empty: str) -> Dict[str, int]:
+    """Consolida um GROUP BY (valor, count) aplicando o rótulo dos valores vazios."""
+    counts: Dict[str, int] = defaultdict(int)
+    for value, total in rows:
+        counts[value or empty] += total
+    return dict(counts)
 
-        kpis = {
-            "processos_total": len(processes),
-            "processos_por_status": dict(process_status),
-            "concluidos_no_mes": concluidos_mes,
-            "concluidos_hoje": concluido_hoje,
-            "deliveries_por_status": dict(deliveries_status),
-            "deliveries_por_tipo": dict(deliveries_tipo),
-            "empresas": len(companies),
-            "fechamento": {
-                "media": round(mean(dias_fechamento), 2) if dias_fechamento else None,
-                "mediana": median(dias_fechamento) if dias_fechamento else None,
-                "n": len(dias_fechamento),
-            },
-        }
 
-        alerts = []
+# Família da série pelo tipo (mesma prioridade do antigo CASE: REINF, EFD, DIFAL)
+_SERIES_FAMILIES = (("REINF", "reinf"), ("EFD", "efd"), ("DIFAL", "difal"))
+
+
+@lru_cache(maxsize=1024)
+def _series_family(tipo: Optional[str]) -> Optional[str]:
+    tipo_upper = (tipo or "").upper()
+    return next((fam for needle, fam in _SERIES_FAMILIES if needle in tipo_upper), None)
+
+
+def _pivot_series(series: Counter) -> Dict[str, Dict[str, int]]:
+    payload: Dict[str, Dict[str, int]] = {}
+    for (competencia, status), total in series.items():
+        payload.setdefault(competencia, {})[status] = total
+    return payload
+
+
+def compute_kpis() -> Dict[str, Any]:
+    ensure_environment()
+    session = get_session()
+    try:
+        # Relacionamentos usados na serialização/alertas vêm carregados (sem N+1);
+        # cada consulta é percorrida uma única vez, então os objetos ORM vêm em
+        # lotes do cursor (yield_per) e não ficam todos em memória ao mesmo tempo
+        processes = session.query(Process).options(selectinload(Process.company)).yield_per(STREAM_BATCH)
+        deliveries = session.query(Delivery).options(joinedload(Delivery.company)).yield_per(STREAM_BATCH)
+        companies = session.query(Company).options(selectinload(Company.deliveries)).yield_per(STREAM_BATCH)
+
+        # Relógio lido uma vez para todo o snapshot
         now = datetime.now(timezone.utc)
+        today = now.date()
+
+        # Uma passada por entidade: serialização, alertas e dias de fechamento
+        # saem do mesmo laço em vez de reler os atributos ORM várias vezes
+        serialized_deliveries: List[Dict[str, Any]] = []
+        delivery_alerts: List[Dict[str, Any]] = []
         for delivery in deliveries:
+            serialized_deliveries.append(_serialize_delivery(delivery))
             if delivery.dt_prazo and delivery.dt_prazo < now and not delivery.dt_entrega:
-                alerts.append(
+                delivery_alerts.append(
                     {
                         "tipo": "obrigacao_atrasada",
                         "empresa": delivery.company.nome if delivery.company else None,
@@ -801,11 +1022,17 @@ def compute_kpis() -> Dict[str, Any]:
                     }
                 )
 
+        serialized_processes: List[Dict[str, Any]] = []
+        process_alerts: List[Dict[str, Any]] = []
+        dias_fechamento: List[int] = []
         for proc in processes:
+            serialized_processes.append(_serialize_process(proc, now))
+            if proc.dt_conclusao:
+                dias_fechamento.append(proc.dt_conclusao.day)
             if proc.status and proc.status.upper().startswith("C"):
                 continue
             if proc.dt_prev_conclusao and proc.dt_prev_conclusao < now:
-                alerts.append(
+                process_alerts.append(
                     {
                         "tipo": "processo_atrasado",
                         "processo": proc.titulo,
@@ -815,29 +1042,79 @@ def compute_kpis() -> Dict[str, Any]:
                     }
                 )
 
-        reinf_series: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
-        efd_series: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
-        difal_series: Dict[str, int] = defaultdict(int)
+        serialized_companies = [_serialize_company(company, today) for company in companies]
+
+        # Contagens agregadas no banco (GROUP BY / COUNT usando os índices)
+        process_status = _tally(
+            session.query(Process.status, func.count()).group_by(Process.status),
+            "Sem status",
+        )
+        # Um único GROUP BY (tipo, competência, situação) alimenta as contagens por
+        # status e por tipo e as séries reinf/efd/difal; as combinações distintas
+        # são poucas perto do número de deliveries
+        delivery_groups = (
+            session.query(Delivery.tipo, Delivery.competencia, Delivery.situacao, func.count())
+            .group_by(Delivery.tipo, Delivery.competencia, Delivery.situacao)
+            .all()
+        )
+        deliveries_status = _tally(((situacao, total) for _, _, situacao, total in delivery_groups), "Sem status")
+        deliveries_tipo = _tally(((tipo, total) for tipo, _, _, total in delivery_groups), "Sem tipo")
+
+        # Limites com fuso (as colunas são comparadas com ``now``, que é UTC); o dia
+        # está contido no mês, então uma varredura do intervalo do mês no índice
+        # de conclusão conta os dois
+        day_start = datetime.combine(today, datetime.min.time(), tzinfo=timezone.utc)
+        day_end = day_start + timedelta(days=1)
+        month_start = day_start.replace(day=1)
+        concluido_hoje, concluidos_mes = (
+            session.query(
+                func.count(case(((Process.dt_conclusao >= day_start) & (Process.dt_conclusao < day_end), 1))),
+                func.count(Process.id),
+            )
+            .filter(Process.dt_conclusao >= month_start, Process.dt_conclusao < month_start + relativedelta(months=1))
+            .one()
+        )
+        concluido_hoje = concluido_hoje or 0
+        concluidos_mes = concluidos_mes or 0
+
+        kpis = {
+            "processos_total": len(serialized_processes),
+            "processos_por_status": process_status,
+            "concluidos_no_mes": concluidos_mes,
+            "concluidos_hoje": concluido_hoje,
+            "deliveries_por_status": deliveries_status,
+            "deliveries_por_tipo": deliveries_tipo,
+            "empresas": len(serialized_companies),
+            "fechamento": _fechamento_stats(dias_fechamento),
+        }
+
+        alerts = delivery_alerts + process_alerts
+
+        # Chaves (competência, status) planas; o aninhamento só na serialização
+        reinf_series: Counter = Counter()
+        efd_series: Counter = Counter()
+        difal_series: Counter = Counter()
+
+        for tipo, competencia, situacao, total in delivery_groups:
+            fam = _series_family(tipo)
+            if fam is None:
+                continue
+            competencia = competencia or "Sem competência"
+            status = situacao or "Sem status"
+            if fam == "reinf":
+                reinf_series[(competencia, status)] += total
+            elif fam == "efd":
+                efd_series[(competencia, status)] += total
+            else:
+                difal_series[status] += total
 
-        for delivery in deliveries:
-            competencia = delivery.competencia or "Sem competência"
-            status = delivery.situacao or "Sem status"
-            tipo = (delivery.tipo or "").upper()
-            if "REINF" in tipo:
-                reinf_series[competencia][status] += 1
-            elif "EFD" in tipo:
-                efd_series[competencia][status] += 1
-            elif "DIFAL" in tipo:
-                difal_series[status] += 1
-
-        states = session.query(Event).all()
         meta = {
-            "last_sync": datetime.now(timezone.utc).isoformat(),
-            "events": len(states),
+            "last_sync": now.isoformat(),
+            "events": session.query(func.count()).select_from(Event).scalar() or 0,
         }
 
-        reinf_payload = {competencia: dict(values) for competencia, values in reinf_series.items()}
-        efd_payload = {competencia: dict(values) for competencia, values in efd_series.items()}
+        reinf_payload = _pivot_series(reinf_series)
+        efd_payload = _pivot_series(efd_series)
         difal_payload = dict(difal_series)
 
         snapshot = {
@@ -848,19 +1125,94 @@ def compute_kpis() -> Dict[str, Any]:
             "efd": efd_payload,
             "difal": difal_payload,
         }
-
-        _write_json(FILES["kpis"], snapshot)
-        _write_json(FILES["alerts"], alerts)
-        _write_json(FILES["fechamento"], kpis.get("fechamento", {}))
-        _write_json(FILES["reinf"], reinf_payload)
-        _write_json(FILES["efd"], efd_payload)
-        _write_json(FILES["difal"], difal_payload)
-        _write_json(FILES["meta"], meta)
-
-        return snapshot
     finally:
         session.close()
 
+    # Tudo já está em dicts: a sessão foi liberada e os arquivos, independentes
+    # entre si, são gravados em paralelo
+    outputs = [
+        (FILES["processes"], serialized_processes),
+        (FILES["deliveries"], serialized_deliveries),
+        (FILES["companies"], serialized_companies),
+        (FILES["kpis"], snapshot),
+        (FILES["alerts"], alerts),
+        (FILES["fechamento"], kpis.get("fechamento", {})),
+        (FILES["reinf"], reinf_payload),
+        (FILES["efd"], efd_payload),
+        (FILES["difal"], difal_payload),
+        (FILES["meta"], meta),
+    ]
+    with ThreadPoolExecutor(max_workers=JSON_WRITE_WORKERS) as pool:
+        # list() propaga a primeira exceção de escrita
+        list(pool.map(lambda item: _write_json(item[0], item[1], human=True), outputs))
+
+    return snapshot
+
+
+@dataclass(frozen=True, slots=True)
+class PipelineResult:
+    """Totais de uma execução do pipeline."""
+
+    processes: int
+    deliveries: int
+    companies: int
+    events: int
+    metrics: Dict[str, Any]
+
+    def to_log_extra(self) -> Dict[str, int]:
+        return {
+            "processes": self.processes,
+            "deliveries": self.deliveries,
+            "companies": self.companies,
+            "events": self.events,
+        }
+
+
+def _run_pipeline_locked(
+    *,
+    full: bool = False,
+    statuses: Optional[List[str]] = None,
+    page_size: int = 100,
+    reset_sync: bool = False,
+    months_history: int = 6,
+    dt_from: Optional[date] = None,
+) -> PipelineResult:
+    """Corpo do pipeline; quem chama já detém o PIPELINE_LOCK."""
+    log(
+        "pipeline",
+        "INFO",
+        "run_start",
+        full=full,
+        statuses=statuses,
+        reset_sync=reset_sync,
+        months_history=months_history,
+    )
+    processes = collect_processes(
+        statuses=statuses,
+        full=full,
+        page_size=page_size,
+        reset_sync=reset_sync,
+        dt_from=dt_from,
+    )
+    deliveries = collect_deliveries(
+        full=full,
+        months_history=months_history,
+        page_size=page_size,
+        reset_sync=reset_sync,
+    )
+    companies = collect_companies()
+    events = build_events()
+    metrics = compute_kpis()
+    result = PipelineResult(
+        processes=len(processes),
+        deliveries=len(deliveries),
+        companies=len(companies),
+        events=len(events),
+        metrics=metrics,
+    )
+    log("pipeline", "INFO", "run_complete", **result.to_log_extra())
+    return result
+
 
 def run_pipeline(
     *,
@@ -870,49 +1222,36 @@ def run_pipeline(
     reset_sync: bool = False,
     months_history: int = 6,
     dt_from: Optional[date] = None,
-) -> Dict[str, Any]:
+) -> PipelineResult:
     with PIPELINE_LOCK:
-        log(
-            "pipeline",
-            "INFO",
-            "run_start",
+        return _run_pipeline_locked(
             full=full,
             statuses=statuses,
-            reset_sync=reset_sync,
-            months_history=months_history,
-        )
-        processes = collect_processes(
-            statuses=statuses,
-            full=full,
             page_size=page_size,
             reset_sync=reset_sync,
-            dt_from=dt_from,
-        )
-        deliveries = collect_deliveries(
-            full=full,
             months_history=months_history,
-            page_size=page_size,
-            reset_sync=reset_sync,
-        )
-        companies = collect_companies()
-        events = build_events()
-        metrics = compute_kpis()
-        log(
-            "pipeline",
-            "INFO",
-            "run_complete",
-            processes=len(processes),
-            deliveries=len(deliveries),
-            companies=len(companies),
-            events=len(events),
+            dt_from=dt_from,
         )
-        return {
-            "processes": len(processes),
-            "deliveries": len(deliveries),
-            "companies": len(companies),
-            "events": len(events),
-            "metrics": metrics,
-        }
+
+
+# Um único worker persistente executa os refreshes pedidos. O trigger já sai
+# com o PIPELINE_LOCK adquirido (acquire não bloqueante, atômico) e o worker o
+# libera ao terminar: pedidos feitos enquanto um refresh ou o scheduler roda
+# são descartados, sem janela entre checar e adquirir
+_REFRESH_QUEUE: SimpleQueue = SimpleQueue()
+_REFRESH_GUARD = threading.Lock()
+_REFRESH_WORKER: Optional[threading.Thread] = None
+
+
+def _refresh_worker() -> None:
+    while True:
+        params = _REFRESH_QUEUE.get()
+        try:
+            _run_pipeline_locked(**params)
+        except Exception as exc:  # pragma: no cover - apenas logging
+            PIPELINE_LOG.exception("Falha ao executar refresh", exc_info=exc)
+        finally:
+            PIPELINE_LOCK.release()
 
 
 def trigger_refresh(
@@ -924,23 +1263,25 @@ def trigger_refresh(
     months_history: int = 6,
     dt_from: Optional[date] = None,
 ) -> bool:
-    if PIPELINE_LOCK.locked():
+    global _REFRESH_WORKER
+    if not PIPELINE_LOCK.acquire(blocking=False):
         return False
-
-    def _runner() -> None:
-        try:
-            run_pipeline(
-                full=full,
-                statuses=statuses,
-                page_size=page_size,
-                reset_sync=reset_sync,
-                months_history=months_history,
-                dt_from=dt_from,
-            )
-        except Exception as exc:  # pragma: no cover - apenas logging
-            PIPELINE_LOG.exception("Falha ao executar refresh", exc_info=exc)
-
-    thread = threading.Thread(target=_runner, name="pipeline-refresh", daemon=True)
-    thread.start()
+    with _REFRESH_GUARD:
+        if _REFRESH_WORKER is None or not _REFRESH_WORKER.is_alive():
+            _REFRESH_WORKER = threading.Thread(target=_refresh_worker, name="pipeline-refresh", daemon=True)
+            try:
+                _REFRESH_WORKER.start()
+            except RuntimeError:
+                PIPELINE_LOCK.release()
+                raise
+        _REFRESH_QUEUE.put(
+            {
+                "full": full,
+                "statuses": statuses,
+                "page_size": page_size,
+                "reset_sync": reset_sync,
+                "months_history": months_history,
+                "dt_from": dt_from,
+            }
+        )
     return True
-
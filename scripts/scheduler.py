@@ -9,10 +9,16 @@ Uso:
 """
 import os
 import sys
-import subprocess
+import json
+import time
 import logging
+import threading
+import importlib
+import subprocess
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from datetime import datetime
+from apscheduler.executors.pool import ThreadPoolExecutor as JobThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from dotenv import load_dotenv
@@ -27,10 +33,90 @@ logger = logging.getLogger("scheduler")
 # Raiz do projeto
 ROOT = Path(__file__).resolve().parents[1]
 ENV_PATH = ROOT / ".env"
+# Controle incremental dos coletores (gravado por fetch_api/fetch_deliveries)
+SYNC_STATE_PATH = ROOT / "data" / ".sync_state.json"
 
 # Carregar .env
 load_dotenv(dotenv_path=ENV_PATH, override=True)
 
+# Os módulos são importados como ``scripts.*`` também quando rodando
+# ``python scripts/scheduler.py``
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from scripts.utils.locks import PIPELINE_LOCK
+from scripts.utils.optional import orjson
+
+
+# (módulo, descrição, dependências). Os coletores de origens diferentes
+# (Acessórias, IMAP) rodam em paralelo; as etapas seguintes esperam só os
+# arquivos que leem. Os três coletores da Acessórias rodam em sequência: cada
+# um usa o rate_budget inteiro do mesmo token, e fetch_api/fetch_deliveries
+# leem e regravam o mesmo data/.sync_state.json
+STAGES = [
+    ("scripts.fetch_api", "Coletando processos da API", []),
+    ("scripts.fetch_deliveries", "Coletando deliveries", ["scripts.fetch_api"]),
+    ("scripts.fetch_companies", "Coletando empresas", ["scripts.fetch_deliveries"]),
+    ("scripts.fetch_email_imap", "Coletando emails", []),
+    ("scripts.flatten_steps", "Processando passos dos processos", ["scripts.fetch_api", "scripts.fetch_deliveries"]),
+    ("scripts.fuse_sources", "Fusionando dados", ["scripts.flatten_steps", "scripts.fetch_email_imap"]),
+    (
+        "scripts.build_processes_kpis_alerts",
+        "Consolidando dados e gerando KPIs",
+        ["scripts.fuse_sources", "scripts.fetch_companies", "scripts.fetch_api"],
+    ),
+]
+STAGE_WORKERS = 4
+# Coletores de rede rodam em subprocesso com timeout: uma conexão travada
+# (IMAP, HTTP) é encerrada e não segura o PIPELINE_LOCK para sempre
+NETWORK_STAGES = {
+    "scripts.fetch_api",
+    "scripts.fetch_deliveries",
+    "scripts.fetch_companies",
+    "scripts.fetch_email_imap",
+}
+STAGE_TIMEOUT = 300  # 5 minutos por módulo
+
+
+def has_api_sync() -> bool:
+    """True se o fetch_api já concluiu uma coleta (``api.last_sync`` no sync_state)."""
+    try:
+        if orjson is not None:
+            state = orjson.loads(SYNC_STATE_PATH.read_bytes())
+        else:
+            state = json.loads(SYNC_STATE_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return False
+    return bool(isinstance(state, dict) and (state.get("api") or {}).get("last_sync"))
+
+
+def _run_stage(module: str, full: bool) -> float:
+    """
+    Executa uma etapa e devolve a duração. Coletores de rede vão em subprocesso
+    com timeout (TimeoutExpired/SystemExit sobem para o chamador); as etapas
+    locais importam o módulo e chamam main() no próprio processo.
+    """
+    started = time.perf_counter()
+    if module in NETWORK_STAGES:
+        # Usar sys.executable para garantir a .venv
+        cmd = [sys.executable, "-m", module]
+        if module == "scripts.fetch_api" and full:
+            cmd.append("--full")
+        result = subprocess.run(
+            cmd,
+            cwd=ROOT,
+            capture_output=True,
+            timeout=STAGE_TIMEOUT,
+            text=True,
+        )
+        if result.returncode != 0:
+            if result.stderr:
+                logger.warning(f"Stderr: {result.stderr[:500]}")
+            raise SystemExit(result.returncode)
+    else:
+        importlib.import_module(module).main()
+    return time.perf_counter() - started
+
 
 def run_pipeline(full: bool = False):
     """
@@ -42,53 +128,47 @@ def run_pipeline(full: bool = False):
     logger.info("=" * 60)
     logger.info("INICIANDO PIPELINE DE COLETA")
     logger.info("=" * 60)
-    
-    modules = [
-        ("scripts.fetch_api", "Coletando processos da API"),
-        ("scripts.fetch_deliveries", "Coletando deliveries"),
-        ("scripts.fetch_companies", "Coletando empresas"),
-        ("scripts.flatten_steps", "Processando passos dos processos"),
-        ("scripts.fetch_email_imap", "Coletando emails"),
-        ("scripts.fuse_sources", "Fusionando dados"),
-        ("scripts.build_processes_kpis_alerts", "Consolidando dados e gerando KPIs"),
-    ]
-    
+
     failed = []
-    
-    for i, (module, description) in enumerate(modules, 1):
-        logger.info(f"[{i}/{len(modules)}] {description}")
-        
-        try:
-            # Usar sys.executable para garantir a .venv
-            cmd = [sys.executable, "-m", module]
-            
-            # Adicionar --full ao fetch_api se necessário
-            if module == "scripts.fetch_api" and full:
-                cmd.append("--full")
-            
-            result = subprocess.run(
-                cmd,
-                cwd=ROOT,
-                capture_output=True,
-                timeout=300,  # 5 minutos por módulo
-                text=True
-            )
-            
-            if result.returncode != 0:
-                logger.warning(f"Módulo {module} retornou código {result.returncode}")
-                if result.stderr:
-                    logger.warning(f"Stderr: {result.stderr[:500]}")
-                failed.append(module)
-            else:
-                logger.info(f"[OK] {description}")
-        
-        except subprocess.TimeoutExpired:
-            logger.error(f"Timeout ao executar {module}")
-            failed.append(module)
-        except Exception as e:
-            logger.error(f"Erro ao executar {module}: {e}")
-            failed.append(module)
-    
+    descriptions = {module: description for module, description, _ in STAGES}
+    pending = {module: set(deps) for module, _, deps in STAGES}
+    running = {}
+    finished = set()
+    started = 0
+
+    # As etapas locais rodam no próprio processo (import uma vez, chama main());
+    # os coletores de rede, em subprocesso com timeout. O lock evita ciclos sobrepostos.
+    # Cada etapa sai assim que suas dependências terminam (com ou sem erro,
+    # como antes: as seguintes usam o último snapshot disponível)
+    with PIPELINE_LOCK, ThreadPoolExecutor(max_workers=STAGE_WORKERS) as pool:
+        while pending or running:
+            for module in [m for m, deps in pending.items() if deps <= finished]:
+                del pending[module]
+                started += 1
+                logger.info(f"[{started}/{len(STAGES)}] {descriptions[module]}")
+                running[pool.submit(_run_stage, module, full)] = module
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                module = running.pop(future)
+                finished.add(module)
+                try:
+                    elapsed = future.result()
+                    logger.info(f"[OK] {descriptions[module]} ({elapsed:.1f}s)")
+                except subprocess.TimeoutExpired:
+                    logger.error(f"Timeout ao executar {module}")
+                    failed.append(module)
+                    continue
+                except SystemExit as e:
+                    if e.code not in (None, 0):
+                        logger.warning(f"Módulo {module} saiu com código {e.code}")
+                        failed.append(module)
+                    else:
+                        logger.info(f"[OK] {descriptions[module]}")
+                except Exception as e:
+                    logger.error(f"Erro ao executar {module}: {e}", exc_info=True)
+                    failed.append(module)
+
     logger.info("=" * 60)
     if failed:
         logger.warning(f"Pipeline concluído com {len(failed)} erro(s): {', '.join(failed)}")
@@ -104,12 +184,20 @@ def main():
     logger.info("Iniciando scheduler de coleta de dados")
     logger.info(f"Raiz do projeto: {ROOT}")
     
-    # Criar scheduler
-    scheduler = BackgroundScheduler()
+    # Criar scheduler: um único job, então uma única thread no executor (o
+    # padrão do APScheduler abre 10). Execuções perdidas (máquina suspensa,
+    # pipeline longo) rodam uma vez só se couberem na tolerância de 10 min
+    scheduler = BackgroundScheduler(
+        executors={"default": JobThreadPoolExecutor(max_workers=1)},
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 600},
+    )
     
-    # Executar pipeline na primeira vez (full=True)
-    logger.info("Executando pipeline inicial (full=True)...")
-    run_pipeline(full=True)
+    # Executar pipeline na primeira vez: full se o fetch_api não tem last_sync
+    # no próprio sync_state (primeira execução, estado apagado ou resetado);
+    # senão um restart continua incremental de onde os coletores pararam
+    full = not has_api_sync()
+    logger.info(f"Executando pipeline inicial (full={full})...")
+    run_pipeline(full=full)
     
     # Agendar execução a cada 3 horas (incremental)
     scheduler.add_job(
@@ -117,8 +205,6 @@ def main():
         trigger=IntervalTrigger(hours=3),
         id="pipeline_job",
         name="Pipeline de coleta a cada 3 horas",
-        coalesce=True,
-        max_instances=1,
         replace_existing=True
     )
     
@@ -128,10 +214,13 @@ def main():
     logger.info("Pressione Ctrl+C para parar.")
     
     try:
-        # Manter o scheduler rodando
-        while True:
-            import time
-            time.sleep(1)
+        # Manter o scheduler rodando: espera bloqueada, sem acordar a cada segundo.
+        # No Windows a espera num lock não é interrompida pelo Ctrl+C, então lá
+        # ela volta a cada 1s como antes
+        stop = threading.Event()
+        timeout = 1 if os.name == "nt" else None
+        while not stop.wait(timeout=timeout):
+            pass
     except KeyboardInterrupt:
         logger.info("Encerrando scheduler...")
         scheduler.shutdown()
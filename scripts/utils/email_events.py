@@ -0,0 +1,103 @@
+"""
+Taxonomia dos eventos dos e-mails padronizados, compartilhada pelos coletores
+Gmail (fetch_email) e IMAP (fetch_email_imap).
+
+Famílias e qualificadores viram uma única regex com grupos nomeados: uma
+varredura do texto devolve o conjunto de grupos presentes, e os handlers das
+famílias, em ordem de prioridade, decidem categoria/subtipo/status.
+"""
+from __future__ import annotations
+
+import re
+from typing import Dict, FrozenSet, Optional, Union
+
+
+def _with_modifier(hits: FrozenSet[str], categoria: str) -> Optional[Dict[str, Optional[str]]]:
+    # "obrigat" tem precedência sobre "dispens" quando ambos aparecem
+    if "obrigat" in hits:
+        return {"categoria": categoria, "subtipo": None, "status": "Obrigatória"}
+    if "dispens" in hits:
+        return {"categoria": categoria, "subtipo": None, "status": "Dispensada"}
+    return None
+
+
+def _map_reinf(hits: FrozenSet[str]) -> Optional[Dict[str, Optional[str]]]:
+    return _with_modifier(hits, "efd_reinf")
+
+
+def _map_contrib(hits: FrozenSet[str]) -> Optional[Dict[str, Optional[str]]]:
+    return _with_modifier(hits, "efd_contrib")
+
+
+def _map_difal(hits: FrozenSet[str]) -> Optional[Dict[str, Optional[str]]]:
+    if "consumo" in hits:
+        return {"categoria": "difal", "subtipo": "consumo_imobilizado", "status": "Obrigatório"}
+    if "comercializ" in hits:
+        return {"categoria": "difal", "subtipo": "comercializacao", "status": "Incidência confirmada"}
+    if "ambos" in hits:
+        return {"categoria": "difal", "subtipo": "ambos", "status": "Incidência confirmada"}
+    return None
+
+
+def _map_fora_das(hits: FrozenSet[str]) -> Optional[Dict[str, Optional[str]]]:
+    if "iss_icms" in hits:
+        return {"categoria": "fora_das", "subtipo": "ISS_ICMS", "status": "Emitir guias"}
+    if "icms" in hits:
+        return {"categoria": "fora_das", "subtipo": "ICMS", "status": "Emitir guia estadual"}
+    if "iss" in hits:
+        return {"categoria": "fora_das", "subtipo": "ISS", "status": "Emitir guia municipal"}
+    return None
+
+
+# Famílias em ordem de prioridade: (nome do grupo, padrão, handler). Famílias
+# sem qualificador levam o resultado fixo no lugar do handler
+_EVENT_FAMILIES = (
+    ("reinf", r"efd[- ]reinf", _map_reinf),
+    ("contrib", r"efd contrib", _map_contrib),
+    ("mit", r"mit preenchida", {"categoria": "mit", "subtipo": "preenchida", "status": "OK"}),
+    ("difal", r"difal", _map_difal),
+    ("fora_das", r"fora do das", _map_fora_das),
+    (
+        "finalizacao",
+        r"processo fiscal finalizado|controle mensal (?:—|-) finalizado",
+        {"categoria": "finalizacao", "subtipo": None, "status": "Finalizado"},
+    ),
+)
+# Qualificadores lidos pelos handlers; "iss e icms" antes de "icms"/"iss"
+# para vencer quando começam na mesma posição
+_EVENT_QUALIFIERS = (
+    ("obrigat", r"obrigat"),
+    ("dispens", r"dispens"),
+    ("consumo", r"consumo|imobiliz"),
+    ("comercializ", r"comercializ"),
+    ("ambos", r"ambos"),
+    ("iss_icms", r"iss e icms"),
+    ("icms", r"icms"),
+    ("iss", r"iss"),
+)
+_EVENT_PATTERN = "|".join(
+    [f"(?P<{name}>{pat})" for name, pat, _ in _EVENT_FAMILIES]
+    + [f"(?P<{name}>{pat})" for name, pat in _EVENT_QUALIFIERS]
+)
+# Mesma regex para texto e para bytes UTF-8 (corpos do Gmail não são decodificados);
+# os padrões não usam classes com caracteres fora do ASCII, então codificar é seguro
+_EVENT_RE = re.compile(_EVENT_PATTERN)
+_EVENT_RE_BYTES = re.compile(_EVENT_PATTERN.encode("utf-8"))
+
+
+def map_event(evento_raw: str, body: Union[bytes, str]) -> Dict[str, Optional[str]]:
+    """Mapeia assunto/corpo em categoria/subtipo/status (None quando nada casa)."""
+    if isinstance(body, bytes):
+        # bytes.lower() só troca ASCII, o que basta: as palavras-chave não têm acentos
+        text = evento_raw.encode("utf-8").lower() + b"\n" + body.lower()
+        matches = _EVENT_RE_BYTES.finditer(text)
+    else:
+        matches = _EVENT_RE.finditer(f"{evento_raw}\n{body}".lower())
+    # Uma única varredura do texto coleta famílias e qualificadores presentes
+    hits = frozenset(m.lastgroup for m in matches)
+    for name, _, handler in _EVENT_FAMILIES:
+        if name in hits:
+            mapping = handler(hits) if callable(handler) else dict(handler)
+            if mapping:
+                return mapping
+    return {"categoria": None, "subtipo": None, "status": None}
@@ -4,7 +4,7 @@ Autenticação OAuth2 para Gmail API
 """
 
 import os
-import pickle
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -17,14 +17,63 @@ SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 CREDENTIALS_FILE = BASE_DIR / 'credentials.json'
 TOKEN_FILE = BASE_DIR / 'token.json'
 
+# Serviço e credenciais reaproveitados entre chamadas no mesmo processo
+_CACHED_SERVICE = None
+_CACHED_CREDS = None
+# Margem antes da expiração para renovar o token com antecedência
+_EXPIRY_MARGIN = timedelta(minutes=5)
+
+
+def _save_creds(creds):
+    TOKEN_FILE.write_text(creds.to_json(), encoding='utf-8')
+
+
+def _load_creds():
+    """Lê token.json no formato JSON do google-auth; migra tokens antigos em pickle."""
+    try:
+        return Credentials.from_authorized_user_file(str(TOKEN_FILE), SCOPES)
+    except (ValueError, UnicodeDecodeError):
+        pass
+    # Formato antigo: pickle gravado com nome .json. Converte uma vez só
+    import pickle
+
+    try:
+        with open(TOKEN_FILE, 'rb') as token:
+            creds = pickle.load(token)
+    except Exception:
+        return None
+    _save_creds(creds)
+    return creds
+
+
+def _fresh_enough(creds):
+    if not creds or not creds.valid:
+        return False
+    if creds.expiry is None:
+        return True
+    # google-auth guarda expiry como datetime UTC ingênuo
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - now > _EXPIRY_MARGIN
+
+
 def get_gmail_service():
-    """Autentica e retorna serviço Gmail"""
+    """Autentica e retorna serviço Gmail (reaproveita o serviço já montado)"""
+    global _CACHED_SERVICE, _CACHED_CREDS
+
+    if _CACHED_SERVICE is not None:
+        if _fresh_enough(_CACHED_CREDS):
+            return _CACHED_SERVICE
+        # refresh() atualiza as credenciais no lugar: o serviço continua válido
+        if _CACHED_CREDS.refresh_token:
+            _CACHED_CREDS.refresh(Request())
+            _save_creds(_CACHED_CREDS)
+            return _CACHED_SERVICE
+
     creds = None
     
     # Token existente
     if TOKEN_FILE.exists():
-        with open(TOKEN_FILE, 'rb') as token:
-            creds = pickle.load(token)
+        creds = _load_creds()
     
     # Refresh se expirado
     if creds and creds.expired and creds.refresh_token:
@@ -43,7 +92,8 @@ def get_gmail_service():
         creds = flow.run_local_server(port=0)
         
         # Salva token
-        with open(TOKEN_FILE, 'wb') as token:
-            pickle.dump(creds, token)
+        _save_creds(creds)
     
-    return build('gmail', 'v1', credentials=creds)
+    _CACHED_CREDS = creds
+    _CACHED_SERVICE = build('gmail', 'v1', credentials=creds, cache_discovery=False)
+    return _CACHED_SERVICE
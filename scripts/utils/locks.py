@@ -0,0 +1,7 @@
+"""Locks compartilhados entre o scheduler e o pipeline (sem dependências)."""
+from __future__ import annotations
+
+import threading
+
+# Um ciclo de coleta por vez no processo, venha do scheduler ou de um refresh
+PIPELINE_LOCK = threading.Lock()
@@ -2,14 +2,32 @@
 from __future__ import annotations
 
 from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
 from pathlib import Path
 import json
+import logging
 import threading
 
+from scripts.utils.optional import orjson
+
 _BASE = Path(__file__).resolve().parents[2]
 _LOG_FILE = _BASE / "data" / "logs.txt"
 _LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
 _LOCK = threading.Lock()
+# Handle de append mantido aberto entre chamadas (aberto sob demanda)
+_FH = None
+_LOGS_DIR = _BASE / "data" / "logs"
+_LOG_FORMAT = "%(asctime)s [%(levelname)s] %(name)s | %(message)s"
+
+def _dumps_line(payload: dict) -> str:
+    """Linha JSON do log; cai no json padrão para o que o orjson recusa (ex.: int > 64 bits)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(payload, ensure_ascii=False)
+
 
 def _ts() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
@@ -25,8 +43,44 @@ def log(component: str, level: str, message: str, **extra):
     }
     if extra:
         payload["extra"] = extra
-    line = json.dumps(payload, ensure_ascii=False)
+    line = _dumps_line(payload)
+    global _FH
     with _LOCK:
-        with _LOG_FILE.open("a", encoding="utf-8") as fh:
-            fh.write(line + "\n")
+        # Um open/close por linha custava mais que o próprio log; o handle fica
+        # aberto e o flush mantém cada linha visível no arquivo na hora
+        if _FH is None or _FH.closed:
+            _FH = _LOG_FILE.open("a", encoding="utf-8")
+        _FH.write(line + "\n")
+        _FH.flush()
     print(f"[{payload['level']}] {component}: {message}")
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Logger padrão gravando em data/logs/<name>.log com rotação (5 MB x 5).
+    Idempotente: chamadas repetidas devolvem o mesmo logger sem reabrir o
+    arquivo nem empilhar handlers.
+    """
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
+    with _LOCK:
+        if logger.handlers:
+            return logger
+        _LOGS_DIR.mkdir(parents=True, exist_ok=True)
+        handler = RotatingFileHandler(
+            _LOGS_DIR / f"{name}.log",
+            maxBytes=5 * 1024 * 1024,
+            backupCount=5,
+            encoding="utf-8",
+        )
+        handler.setFormatter(logging.Formatter(_LOG_FORMAT))
+        logger.addHandler(handler)
+        if logger.level == logging.NOTSET:
+            logger.setLevel(logging.INFO)
+    return logger
+
+
+def setup_logger(name: str) -> logging.Logger:
+    """Nome antigo mantido por compatibilidade; delega para ``get_logger``."""
+    return get_logger(name)
@@ -2,14 +2,20 @@
 from __future__ import annotations
 
 import re
-from datetime import datetime
-from typing import Any
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, List
 
 from dateutil import parser
 
-_BR_DATE_RE = re.compile(r"^\d{2}/\d{2}/\d{4}$")
-_BR_DATETIME_RE = re.compile(r"^\d{2}/\d{2}/\d{4}\s+\d{2}:\d{2}(:\d{2})?$")
 _MONEY_RE = re.compile(r"^-?\d{1,3}(\.\d{3})*,\d{2}$")
+# Data/hora BR, data BR e valor monetário numa alternação só: uma entrada no
+# motor de regex por string e o grupo nomeado diz qual formato casou
+_BR_VALUE_RE = re.compile(
+    r"^(?:(?P<dt>\d{2}/\d{2}/\d{4}\s+\d{2}:\d{2}(?::\d{2})?)"
+    r"|(?P<d>\d{2}/\d{2}/\d{4})"
+    r"|(?P<m>\d{1,3}(?:\.\d{3})*,\d{2}))$"
+)
 
 
 def _parse_br_datetime(value: str) -> datetime | None:
@@ -28,29 +34,77 @@ def _parse_br_date(value: str) -> datetime | None:
         return None
 
 
+def _local_tz_window() -> tuple[Any, datetime | None, datetime | None]:
+    """
+    Fuso local resolvido uma vez só. O offset fixo só vale enquanto o fuso não
+    muda (horário de verão); por isso amostra ~2 anos para trás e 1 para frente
+    e devolve a janela em que o offset é estável (ou sem janela se variar).
+    """
+    now = datetime.now(timezone.utc)
+    tz = now.astimezone().tzinfo
+    offset = now.astimezone().utcoffset()
+    start, end = now - timedelta(days=730), now + timedelta(days=365)
+    probe = start
+    while probe <= end:
+        if probe.astimezone().utcoffset() != offset:
+            return tz, None, None
+        probe += timedelta(days=10)
+    return tz, start, end
+
+
+_LOCAL_TZ, _LOCAL_TZ_FROM, _LOCAL_TZ_UNTIL = _local_tz_window()
+
+
 def _to_iso(dt: datetime) -> str:
     dt = dt.replace(microsecond=0)
     if dt.tzinfo:
+        # astimezone() sem argumento consulta o fuso do SO a cada chamada;
+        # dentro da janela estável o tzinfo em cache dá o mesmo resultado
+        if _LOCAL_TZ_FROM is not None and _LOCAL_TZ_FROM <= dt <= _LOCAL_TZ_UNTIL:
+            return dt.astimezone(_LOCAL_TZ).isoformat()
         return dt.astimezone().replace(microsecond=0).isoformat()
     return dt.isoformat(sep=" ")
 
 
-def normalize_string(value: str) -> Any:
+def _normalize_string(value: str) -> Any:
+    # strip() já devolve o próprio objeto quando não há espaço nas pontas
     raw = value.strip()
     if not raw:
         return value
-    if _BR_DATETIME_RE.match(raw):
-        parsed = _parse_br_datetime(raw)
-        if parsed:
-            return _to_iso(parsed)
-    if _BR_DATE_RE.match(raw):
-        parsed = _parse_br_date(raw)
-        if parsed:
-            return parsed.strftime("%Y-%m-%d")
-    if _MONEY_RE.match(raw):
-        as_float = float(raw.replace(".", "").replace(",", "."))
-        return as_float
-    # Attempt ISO parsing as a last resort (preserves already ISO strings)
+    # Todos os formatos tratados começam com dígito ("-" no valor monetário, "+"
+    # aceito pelo isoparse): nomes/descrições saem aqui sem regex nem isoparse
+    c0 = raw[0]
+    if c0 == "-":
+        if "," in raw and _MONEY_RE.match(raw):
+            return float(raw.replace(".", "").replace(",", "."))
+        return value
+    if not (c0.isdigit() or c0 == "+"):
+        return value
+    if raw[2:3] == "/" or "," in raw:
+        match = _BR_VALUE_RE.match(raw)
+        if match:
+            kind = match.lastgroup
+            if kind == "m":
+                return float(raw.replace(".", "").replace(",", "."))
+            if kind == "dt":
+                parsed = _parse_br_datetime(raw)
+                if parsed:
+                    return _to_iso(parsed)
+            else:
+                parsed = _parse_br_date(raw)
+                if parsed:
+                    return parsed.strftime("%Y-%m-%d")
+    # Attempt ISO parsing as a last resort (preserves already ISO strings).
+    # O formato estendido (YYYY-MM-DD[THH:MM...]) que a API devolve vai pelo
+    # fromisoformat em C; o resto (básico, só ano, semanas) segue no isoparse,
+    # já que o fromisoformat aceitaria sequências de dígitos como CNPJ
+    if len(raw) >= 10 and raw[4] == "-" and (len(raw) == 10 or raw[10] in "T "):
+        try:
+            if raw[-1] == "Z":
+                raw = raw[:-1] + "+00:00"
+            return _to_iso(datetime.fromisoformat(raw))
+        except ValueError:
+            pass
     try:
         parsed = parser.isoparse(raw)
         return _to_iso(parsed)
@@ -58,6 +112,18 @@ def normalize_string(value: str) -> Any:
         return value
 
 
+# Os mesmos textos curtos (status, nomes de empresa, datas da competência) se
+# repetem em milhares de registros; textos longos passam direto, sem ocupar o cache
+_STRING_CACHE_MAX_LEN = 64
+_normalize_string_cached = lru_cache(maxsize=8192)(_normalize_string)
+
+
+def normalize_string(value: str) -> Any:
+    if len(value) > _STRING_CACHE_MAX_LEN:
+        return _normalize_string(value)
+    return _normalize_string_cached(value)
+
+
 def normalize_value(value: Any) -> Any:
     if isinstance(value, dict):
         return {k: normalize_value(v) for k, v in value.items()}
@@ -71,5 +137,36 @@ def normalize_value(value: Any) -> Any:
 
 
 def normalize_structure(payload: Any) -> Any:
-    """Normalize a nested payload of dicts/lists coming from the API."""
-    return normalize_value(payload)
+    """
+    Normalize a nested payload of dicts/lists coming from the API.
+
+    Containers are normalized in place with an explicit stack (no recursion,
+    no copies of unchanged dicts/lists); a container reached twice is only
+    normalized once, since normalize_string is not idempotent.
+    """
+    if not isinstance(payload, (dict, list)):
+        return normalize_value(payload)
+    stack: List[Any] = [payload]
+    seen = set()
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        for key, value in (node.items() if isinstance(node, dict) else enumerate(node)):
+            if isinstance(value, (dict, list)):
+                stack.append(value)
+            elif isinstance(value, str):
+                node[key] = normalize_string(value)
+            elif isinstance(value, datetime):
+                node[key] = _to_iso(value)
+    return payload
+
+
+def normalize_structures(items: List[Any]) -> List[Any]:
+    """Normalize a list of API records in a single pass."""
+    _normalize = normalize_structure
+    out: List[Any] = [None] * len(items)
+    for i in range(len(items)):
+        out[i] = _normalize(items[i])
+    return out
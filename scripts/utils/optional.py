@@ -0,0 +1,36 @@
+"""
+Dependências opcionais de desempenho (requirements-perf.txt).
+
+``from scripts.utils.optional import orjson`` devolve o módulo, ou None quando o
+pacote não está instalado; quem usa testa ``is None`` e segue pela stdlib.
+A importação é feita sob demanda, só do nome pedido.
+"""
+from __future__ import annotations
+
+import importlib
+from types import ModuleType
+from typing import Optional
+
+# nome exportado -> módulo importado
+_PACKAGES = {
+    "orjson": "orjson",            # JSON em C/Rust, direto para bytes UTF-8
+    "ijson": "ijson",              # leitura de arrays JSON item a item
+    "ahocorasick": "ahocorasick",  # pyahocorasick: várias substrings numa varredura
+    "xxhash": "xxhash",            # hash rápido dos artefatos (senão blake2b)
+    "np": "numpy",                 # estatísticas de fechamento
+}
+
+
+def optional_import(name: str) -> Optional[ModuleType]:
+    try:
+        return importlib.import_module(name)
+    except Exception:
+        return None
+
+
+def __getattr__(name: str) -> Optional[ModuleType]:
+    if name not in _PACKAGES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = optional_import(_PACKAGES[name])
+    globals()[name] = module
+    return module
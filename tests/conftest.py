@@ -0,0 +1,7 @@
+"""Coloca a raiz do projeto no sys.path para os testes importarem ``scripts.*``."""
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
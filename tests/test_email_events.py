@@ -0,0 +1,44 @@
+"""Taxonomia dos eventos de e-mail (scripts.utils.email_events.map_event)."""
+import pytest
+
+from scripts.utils.email_events import map_event
+
+NONE = {"categoria": None, "subtipo": None, "status": None}
+
+
+@pytest.mark.parametrize(
+    "evento, body, expected",
+    [
+        # "iss e icms" vence "icms"/"iss", em qualquer ordem no texto
+        ("Fora do DAS", "Recolher ISS e ICMS", ("fora_das", "ISS_ICMS", "Emitir guias")),
+        ("Fora do DAS", "ICMS; depois ISS e ICMS", ("fora_das", "ISS_ICMS", "Emitir guias")),
+        ("Fora do DAS", "Recolher ICMS", ("fora_das", "ICMS", "Emitir guia estadual")),
+        ("Fora do DAS", "Recolher ISS", ("fora_das", "ISS", "Emitir guia municipal")),
+        ("Fora do DAS", "ICMS e ISS", ("fora_das", "ICMS", "Emitir guia estadual")),
+        # Famílias em ordem de prioridade
+        ("EFD-Reinf obrigatória", "fora do das: icms", ("efd_reinf", None, "Obrigatória")),
+        ("EFD Reinf", "dispensada", ("efd_reinf", None, "Dispensada")),
+        ("EFD Reinf", "obrigatória, não dispensada", ("efd_reinf", None, "Obrigatória")),
+        # Família sem qualificador cai para a próxima presente
+        ("EFD Reinf", "MIT preenchida", ("mit", "preenchida", "OK")),
+        ("EFD Contribuições", "obrigatória", ("efd_contrib", None, "Obrigatória")),
+        ("DIFAL", "Consumo/Imobilizado e comercialização", ("difal", "consumo_imobilizado", "Obrigatório")),
+        ("DIFAL", "Comercialização", ("difal", "comercializacao", "Incidência confirmada")),
+        ("DIFAL", "Ambos", ("difal", "ambos", "Incidência confirmada")),
+        ("Controle mensal — finalizado", "", ("finalizacao", None, "Finalizado")),
+        ("Controle mensal - finalizado", "", ("finalizacao", None, "Finalizado")),
+        ("Processo fiscal finalizado", "", ("finalizacao", None, "Finalizado")),
+    ],
+)
+def test_map_event(evento, body, expected):
+    categoria, subtipo, status = expected
+    mapping = {"categoria": categoria, "subtipo": subtipo, "status": status}
+    assert map_event(evento, body) == mapping
+    # Corpo do Gmail chega em bytes UTF-8
+    assert map_event(evento, body.encode("utf-8")) == mapping
+
+
+@pytest.mark.parametrize("evento, body", [("", ""), ("Reunião", "ICMS"), ("DIFAL", "sem qualificador")])
+def test_map_event_without_category(evento, body):
+    assert map_event(evento, body) == NONE
+    assert map_event(evento, body.encode("utf-8")) == NONE
@@ -0,0 +1,100 @@
+"""Casamento de regras do flatten_steps (compile_rules/match_rule)."""
+import json
+import random
+
+import pytest
+
+from scripts.flatten_steps import RULES_PATH, compile_rules, match_rule
+
+
+def _reference_match(name, rules):
+    # Laço original: a primeira regra (na ordem do rules.json) cujo ``contains``
+    # aparece no nome vence
+    low = (name or "").lower()
+    for rule in rules:
+        needle = rule.get("contains", "").lower()
+        if needle and needle in low:
+            return rule
+    return None
+
+
+def _rules(*needles):
+    return [{"contains": needle, "id": i} for i, needle in enumerate(needles)]
+
+
+@pytest.mark.parametrize(
+    "needles, name, expected",
+    [
+        # Mesmo início: vence a primeira da lista, não a mais longa
+        (("fechamento", "fechamento fiscal"), "Fechamento Fiscal", 0),
+        (("fechamento fiscal", "fechamento"), "Fechamento Fiscal", 0),
+        # A regra anterior vence mesmo casando mais adiante no nome
+        (("fiscal", "fechamento"), "Fechamento Fiscal", 0),
+        (("fechamento", "fiscal"), "Fechamento Fiscal", 0),
+        # Uma dentro da outra: a interna casa em posição posterior
+        (("icms e iss", "icms", "iss"), "Recolhimento de ICMS e ISS", 0),
+        (("iss", "icms e iss"), "Recolhimento de ICMS e ISS", 0),
+        (("icms", "icms e iss"), "Recolhimento de ICMS e ISS", 0),
+        # Só a segunda casa
+        (("reinf", "difal"), "Tipo de DIFAL", 1),
+    ],
+)
+def test_first_rule_wins_with_overlapping_needles(needles, name, expected):
+    rules = _rules(*needles)
+    assert match_rule(name, compile_rules(rules))["id"] == expected
+    assert match_rule(name, rules)["id"] == expected
+
+
+def test_no_match_and_empty_rules():
+    assert match_rule("Conferir balancete", compile_rules(_rules("reinf"))) is None
+    assert match_rule("", compile_rules(_rules("reinf"))) is None
+    assert match_rule(None, compile_rules(_rules("reinf"))) is None
+    assert match_rule("qualquer", compile_rules([])) is None
+    # Regras sem ``contains`` são ignoradas, inclusive na contagem dos grupos
+    rules = [{"categoria": "x"}, {"contains": ""}, {"contains": "reinf", "id": 2}]
+    assert match_rule("EFD REINF", compile_rules(rules))["id"] == 2
+
+
+def test_needles_are_literal_and_case_insensitive():
+    rules = _rules("(a+b)", "a.b", "DIFAL → Ambos")
+    matcher = compile_rules(rules)
+    assert match_rule("passo (A+B)", matcher)["id"] == 0
+    assert match_rule("axb", matcher) is None
+    assert match_rule("A.B", matcher)["id"] == 1
+    assert match_rule("tipo de difal → ambos", matcher)["id"] == 2
+
+
+def test_cached_result_matches_first_lookup():
+    matcher = compile_rules(_rules("fiscal", "fechamento"))
+    first = match_rule("Fechamento Fiscal", matcher)
+    assert match_rule("Fechamento Fiscal", matcher) is first
+    assert match_rule("Outro passo", matcher) is None
+    assert match_rule("Outro passo", matcher) is None
+
+
+def test_matches_reference_on_random_names():
+    rng = random.Random(15)
+    words = ["efd", "reinf", "icms", "iss", "e", "das", "fora", "do", "difal", "ambos", "mit"]
+    for _ in range(300):
+        rules = _rules(*(
+            " ".join(rng.choice(words) for _ in range(rng.randint(1, 2)))
+            for _ in range(rng.randint(1, 6))
+        ))
+        matcher = compile_rules(rules)
+        for _ in range(20):
+            name = " ".join(rng.choice(words) for _ in range(rng.randint(0, 6)))
+            assert match_rule(name, matcher) is _reference_match(name, rules)
+
+
+def test_rules_json_keeps_its_mapping():
+    rules = json.loads(RULES_PATH.read_text(encoding="utf-8"))["matchers"]
+    matcher = compile_rules(rules)
+    cases = {
+        "Recolhimento de ISS por fora do DAS": "ISS",
+        "Recolhimento de ICMS por fora do DAS": "ICMS",
+        "Recolhimento de ICMS e ISS por fora do DAS": "ISS_ICMS",
+    }
+    for name, subtipo in cases.items():
+        assert match_rule(name, matcher)["subtipo"] == subtipo
+    assert match_rule("Validar MIT preenchida — EFD Contribuições", matcher)["categoria"] == "efd_contrib"
+    assert match_rule("Processo fiscal encerrado", matcher)["categoria"] == "finalizacao"
@@ -0,0 +1,62 @@
+"""Formatos reconhecidos por normalization.normalize_string."""
+from datetime import datetime, timezone
+
+import pytest
+
+from scripts.utils.normalization import _normalize_string, normalize_string
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        # Data BR
+        ("15/01/2024", "2024-01-15"),
+        ("  15/01/2024 ", "2024-01-15"),
+        ("31/02/2024", "31/02/2024"),
+        # Data/hora BR (com e sem segundos), sem fuso
+        ("15/01/2024 10:30", "2024-01-15 10:30:00"),
+        ("15/01/2024 10:30:45", "2024-01-15 10:30:45"),
+        ("15/01/2024   10:30", "2024-01-15 10:30:00"),
+        ("15/01/2024 25:30", "15/01/2024 25:30"),
+        # Valor monetário BR
+        ("1.234,56", 1234.56),
+        ("0,50", 0.5),
+        ("-1.234,56", -1234.56),
+        ("1234,56", "1234,56"),
+        ("1.23,45", "1.23,45"),
+        # ISO estendido sem fuso
+        ("2024-01-15", "2024-01-15 00:00:00"),
+        ("2024-01-15T10:30:00", "2024-01-15 10:30:00"),
+        ("2024-01-15 10:30:00.123456", "2024-01-15 10:30:00"),
+        # ISO básico (isoparse)
+        ("20240115", "2024-01-15 00:00:00"),
+        # Não são datas/valores: voltam intactos (sem strip)
+        ("12345678000190", "12345678000190"),
+        ("-", "-"),
+        ("-abc", "-abc"),
+        (" Empresa LTDA ", " Empresa LTDA "),
+        ("   ", "   "),
+        ("", ""),
+        ("2024-13-45", "2024-13-45"),
+    ],
+)
+def test_normalize_string(value, expected):
+    assert normalize_string(value) == expected
+    assert _normalize_string(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value, utc",
+    [
+        ("2024-01-15T10:30:00Z", datetime(2024, 1, 15, 10, 30, tzinfo=timezone.utc)),
+        ("2024-01-15T10:30:00+00:00", datetime(2024, 1, 15, 10, 30, tzinfo=timezone.utc)),
+        ("2024-01-15T07:30:00-03:00", datetime(2024, 1, 15, 10, 30, tzinfo=timezone.utc)),
+    ],
+)
+def test_aware_iso_is_converted_to_local_time(value, utc):
+    assert normalize_string(value) == utc.astimezone().isoformat()
+
+
+def test_long_strings_skip_the_cache():
+    long_text = "x" * 100
+    assert normalize_string(long_text) is long_text